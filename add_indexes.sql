@@ -0,0 +1,25 @@
+-- indexes for the cluster, sample and variant lookups of all snapperdb3 databases
+-- can be run on existing databases, CONCURRENTLY means the tables are not locked while they are built
+
+-- one per level so that 'WHERE tN=...' is an index only scan returning the members
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sc_t0 ON sample_clusters (t0, fk_sample_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sc_t5 ON sample_clusters (t5, fk_sample_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sc_t10 ON sample_clusters (t10, fk_sample_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sc_t25 ON sample_clusters (t25, fk_sample_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sc_t50 ON sample_clusters (t50, fk_sample_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sc_t100 ON sample_clusters (t100, fk_sample_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sc_t250 ON sample_clusters (t250, fk_sample_id);
+
+-- the snp address of a sample is looked up by sample id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sc_sample ON sample_clusters (fk_sample_id);
+
+-- samples are looked up by name and names are joined onto sample ids
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_samples_name ON samples (sample_name);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_samples_id_name ON samples (pk_id, sample_name);
+
+-- variants are read per sample and contig, by get_sample_distances_by_id and for alignments
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_variants_sample_contig ON variants (fk_sample_id, fk_contig_id);
+
+ANALYZE sample_clusters;
+ANALYZE samples;
+ANALYZE variants;
@@ -4,6 +4,8 @@ import argparse
 import logging
 import json
 import gzip
+import binascii
+import multiprocessing
 import psycopg2
 from psycopg2.extras import DictCursor
 
@@ -13,6 +15,15 @@ __version__ = '0.1'
 __date__ = '05Sep2018'
 __author__ = 'ulf.schaefer@phe.gov.uk'
 
+HAVE_ORJSON = True
+try:
+    import orjson
+except ImportError:
+    HAVE_ORJSON = False
+
+# int.bit_count() maps to the hardware popcount instruction where the CPU has one (Python >= 3.10)
+HAVE_BIT_COUNT = hasattr(int, 'bit_count')
+
 # --------------------------------------------------------------------------------------------------
 
 def parse_args():
@@ -55,11 +66,311 @@ def parse_args():
                         dest="sam_name_in",
                         help="Sample name. Default: Name of json file before the 1st dot.")
 
+    parser.add_argument("--cache",
+                        type=str,
+                        metavar="CACHEFILE",
+                        default=None,
+                        dest="cache",
+                        help="""Keep the packed variants of all database samples in this file and only
+read samples from the database that are not in it yet. Default: no cache.""")
+
+    parser.add_argument("--processes",
+                        "-p",
+                        type=int,
+                        metavar="INT",
+                        default=1,
+                        dest="processes",
+                        help="Number of processes to calculate the distances with. Default: 1")
+
     oArgs = parser.parse_args()
     return oArgs
 
 # --------------------------------------------------------------------------------------------------
 
+def get_bitset(positions, stride=1, offset=0):
+    """
+    Pack a collection of genome positions into an integer used as a bitset,
+    i.e. bit (p * stride + offset) is set for position p.
+    Parameters
+    ----------
+    positions: list of int
+        genome positions, duplicates are fine
+    stride: int
+        number of bits per genome position [default: 1]
+    offset: int
+        bit within each stride used for these positions [default: 0]
+    Returns
+    -------
+    bits: int
+        bitset
+    """
+
+    if len(positions) <= 0:
+        return 0
+
+    ba = bytearray(((max(positions) * stride + offset) >> 3) + 1)
+    for p in positions:
+        b = p * stride + offset
+        ba[b >> 3] |= 1 << (b & 7)
+    # int() reads the most significant byte first
+    ba.reverse()
+
+    return int(binascii.hexlify(ba), 16)
+
+# --------------------------------------------------------------------------------------------------
+
+def popcount(bits):
+    """
+    Count the number of set bits in a bitset. Uses the native popcount if available.
+    Parameters
+    ----------
+    bits: int
+        bitset
+    Returns
+    -------
+    no name: int
+        number of positions in the bitset
+    """
+
+    if HAVE_BIT_COUNT == True:
+        return bits.bit_count()
+    return bin(bits).count('1')
+
+# --------------------------------------------------------------------------------------------------
+
+def encode_genotype(bits):
+    """
+    Re-encode the four mutually exclusive nucleotide bitsets as a 2 bit base index
+    (A=00, C=01, G=10, T=11) held in two bit planes plus a mask of called positions.
+    Two genotypes then differ wherever (V ^ V') | (lo ^ lo') | (hi ^ hi') is set.
+    Parameters
+    ----------
+    bits: dict
+        {'A': int, 'C': int, 'G': int, 'T': int, 'N': int} bitsets
+    Returns
+    -------
+    no name: tuple
+        (V, lo, hi, N) bitsets
+    """
+
+    return (bits['A'] | bits['C'] | bits['G'] | bits['T'],
+            bits['C'] | bits['T'],
+            bits['G'] | bits['T'],
+            bits['N'])
+
+# --------------------------------------------------------------------------------------------------
+
+def write_json_gz(obj, filename):
+    """
+    Serialise an object to json and write it to a gzipped file in one go.
+    Uses orjson if available.
+    Parameters
+    ----------
+    obj: dict
+        object to serialise
+    filename: str
+        output file name
+    Returns
+    -------
+    0
+    """
+
+    if HAVE_ORJSON == True:
+        payload = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    # the files are read back once, so fast compression is worth more than the last few percent
+    with gzip.open(filename, 'wb', compresslevel=3) as f:
+        f.write(payload)
+
+    return 0
+
+# --------------------------------------------------------------------------------------------------
+
+def read_cache(cachefile, contig_ids):
+    """
+    Read the packed genotypes of database samples from a cache file.
+    Parameters
+    ----------
+    cachefile: str
+        cache file name, may not exist yet
+    contig_ids: list of int
+        sorted contig ids the bitsets need to have been made for
+    Returns
+    -------
+    variants: dict
+        {sample_id: genotype as returned by encode_genotype(), ...}
+        empty if there is no usable cache
+    """
+
+    if os.path.exists(cachefile) == False:
+        return {}
+
+    with gzip.open(cachefile) as f:
+        cache = json.load(f)
+
+    # the interleaving of the bitsets depends on the contigs in the db
+    if cache['contigs'] != contig_ids:
+        logging.warning("Cache %s was made for different contigs. Ignoring it.", cachefile)
+        return {}
+
+    # bitsets are stored as hex strings, which convert in linear time
+    return {int(samid): tuple(int(x, 16) for x in bits) for samid, bits in cache['samples'].items()}
+
+# --------------------------------------------------------------------------------------------------
+
+def write_cache(cachefile, contig_ids, variants):
+    """
+    Write the packed genotypes of database samples to a cache file.
+    Parameters
+    ----------
+    cachefile: str
+        cache file name
+    contig_ids: list of int
+        sorted contig ids the bitsets were made for
+    variants: dict
+        {sample_id: genotype as returned by encode_genotype(), ...}
+    Returns
+    -------
+    0
+    """
+
+    cache = {'contigs': contig_ids,
+             'samples': {samid: ['%x' % x for x in bits] for samid, bits in variants.items()}}
+    write_json_gz(cache, cachefile)
+
+    return 0
+
+# --------------------------------------------------------------------------------------------------
+
+def calculate_distances(samples, variants, query):
+    """
+    Calculate the distance of the query to all samples in a single pass.
+    Parameters
+    ----------
+    samples: dict
+        {sample_id: sample_name, ...}
+    variants: dict
+        {sample_id: genotype as returned by encode_genotype(), ...}
+    query: tuple
+        genotype of the query as returned by encode_genotype()
+    Returns
+    -------
+    distances: list of tuples
+        [(sample_id, sample_name, distance), ...] unsorted
+    """
+
+    (q_v, q_lo, q_hi, q_n) = query
+    # positions not ignored in the query, so that only the sample N needs masking per sample
+    q_keep = ~q_n
+    # skip the masking altogether where there is nothing to mask
+    q_masked = q_n != 0
+    _popcount = int.bit_count if HAVE_BIT_COUNT == True else popcount
+
+    distances = []
+    for samid, sam_name in samples.items():
+        (s_v, s_lo, s_hi, s_n) = variants[samid]
+        diff = (s_v ^ q_v) | (s_lo ^ q_lo) | (s_hi ^ q_hi)
+        if q_masked:
+            diff &= q_keep
+        if s_n != 0:
+            diff &= ~s_n
+        distances.append((samid, sam_name, _popcount(diff)))
+
+    return distances
+
+# --------------------------------------------------------------------------------------------------
+
+def _get_fork_pool(processes):
+    """
+    **PRIVATE**
+
+    Get a pool of forked worker processes, so that the workers see the module globals
+    of the parent without them being pickled.
+    Parameters
+    ----------
+    processes: int
+        number of processes
+    Returns
+    -------
+    pool: obj
+        multiprocessing pool or None if processes can't be forked here
+    """
+
+    if os.name != 'posix':
+        return None
+    try:
+        ctx = multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2 always forks on posix
+        ctx = multiprocessing
+    except ValueError:
+        return None
+    return ctx.Pool(processes)
+
+# --------------------------------------------------------------------------------------------------
+
+# (samples, variants, query) of the current calculate_distances_parallel() call, inherited by the
+# forked workers, so only lists of sample ids go to them
+_SHARED = None
+
+def _calculate_distances_chunk(samids):
+    """
+    **PRIVATE**
+
+    Calculate the distances of the query to the given samples from _SHARED.
+    """
+
+    (samples, variants, query) = _SHARED
+    return calculate_distances({samid: samples[samid] for samid in samids}, variants, query)
+
+# --------------------------------------------------------------------------------------------------
+
+def calculate_distances_parallel(samples, variants, query, processes):
+    """
+    Calculate the distance of the query to all samples, splitting the samples into
+    one chunk per process. The bitsets are not pickled, the workers are forked after
+    the data is in place and only sample ids and distances go between the processes.
+    Parameters
+    ----------
+    samples: dict
+        {sample_id: sample_name, ...}
+    variants: dict
+        {sample_id: genotype as returned by encode_genotype(), ...}
+    query: tuple
+        genotype of the query as returned by encode_genotype()
+    processes: int
+        number of processes
+    Returns
+    -------
+    distances: list of tuples
+        [(sample_id, sample_name, distance), ...] unsorted
+    """
+
+    if processes <= 1 or len(samples) < processes:
+        return calculate_distances(samples, variants, query)
+
+    global _SHARED
+    _SHARED = (samples, variants, query)
+    try:
+        pool = _get_fork_pool(processes)
+        if pool == None:
+            logging.warning("Can't fork worker processes here, calculating distances in one process.")
+            return calculate_distances(samples, variants, query)
+        samids = list(samples.keys())
+        try:
+            results = pool.map(_calculate_distances_chunk, [samids[i::processes] for i in range(processes)])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _SHARED = None
+
+    return [x for chunk_result in results for x in chunk_result]
+
+# --------------------------------------------------------------------------------------------------
+
 def main():
     '''
     Main funtion
@@ -84,11 +395,6 @@ def main():
     with open_func(oArgs.vars) as f:
         data = json.load(f)
 
-    # print data['positions'][u'gi|206707319|emb|AM933172.1|'].keys()
-    for cnt in data['positions'].keys():
-        for nt in data['positions'][cnt].keys():
-            data['positions'][cnt][nt] = set(data['positions'][cnt][nt])
-
     try:
         # open source db
         conn = psycopg2.connect(oArgs.db)
@@ -101,6 +407,24 @@ def main():
 
         logging.debug("%i contigs found.", len(contigs))
 
+        # all contigs are interleaved into one genome wide bitset per nucleotide, so that
+        # position p on contig i is bit p * nof_contigs + i
+        nof_contigs = len(contigs)
+        contig_idx = {c_id: i for i, c_id in enumerate(sorted(contigs.keys()))}
+
+        query = {'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0}
+        for c_id, c_nme in contigs.items():
+            # contigs that are all reference might be absent from the json file
+            positions = data['positions'].get(c_nme, {})
+            ci = contig_idx[c_id]
+            for nt in ['A', 'C', 'G', 'T']:
+                query[nt] |= get_bitset(positions.get(nt, []), nof_contigs, ci)
+            query['N'] |= get_bitset(positions.get('N', []), nof_contigs, ci) \
+                          | get_bitset(positions.get('-', []), nof_contigs, ci)
+        query = encode_genotype(query)
+        # the query is resolved into bitsets once, the json data is not needed any more
+        data = None
+
         # get all samples that are NOT ignored and that have a SNP address
         sql = "SELECT c.fk_sample_id, s.sample_name FROM samples s, sample_clusters c WHERE s.pk_id=c.fk_sample_id AND s.ignore_sample IS FALSE"
         cur.execute(sql)
@@ -109,19 +433,43 @@ def main():
 
         logging.debug("%i samples found.", len(samples))
 
-        sql = "SELECT fk_sample_id, fk_contig_id, a_pos, c_pos, g_pos, t_pos, n_pos, gap_pos FROM variants WHERE fk_sample_id IN %s"
-        cur.execute(sql, (tuple(samples.keys()), ))
+        # variants of samples don't change once they are in the database, so any sample found
+        # in the cache does not need to be read again
         variants = {}
-        for row in cur.fetchall():
-            try:
-                _ = variants[row['fk_sample_id']]
-            except KeyError:
-                variants[row['fk_sample_id']] = {}
-            variants[row['fk_sample_id']][row['fk_contig_id']] = {'A': set(row['a_pos']),
-                                                                  'C': set(row['c_pos']),
-                                                                  'G': set(row['g_pos']),
-                                                                  'T': set(row['t_pos']),
-                                                                  'N': set(row['n_pos'] + row['gap_pos'])}
+        if oArgs.cache != None:
+            variants = read_cache(oArgs.cache, sorted(contigs.keys()))
+            variants = {samid: bits for samid, bits in variants.items() if samid in samples}
+            logging.debug("%i variant sets found in cache.", len(variants))
+        missing = [samid for samid in samples.keys() if samid not in variants]
+
+        if len(missing) > 0:
+            # stream the variants through a server side cursor, so that only itersize rows are held
+            # in memory at any time and each row is packed into the bitsets as it arrives
+            # plain tuples, no DictRow per row
+            var_cur = conn.cursor(name='variants_stream')
+            var_cur.itersize = 1000
+            sql = "SELECT fk_sample_id, fk_contig_id, a_pos, c_pos, g_pos, t_pos, n_pos, gap_pos FROM variants WHERE fk_sample_id = ANY(%s)"
+            var_cur.execute(sql, (list(missing), ))
+            packed = {}
+            for (samid, contig_id, a_pos, c_pos, g_pos, t_pos, n_pos, gap_pos) in var_cur:
+                try:
+                    bits = packed[samid]
+                except KeyError:
+                    bits = packed[samid] = {'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0}
+                ci = contig_idx[contig_id]
+                # positions are scattered straight into the bitsets, no intermediate sets required
+                bits['A'] |= get_bitset(a_pos, nof_contigs, ci)
+                bits['C'] |= get_bitset(c_pos, nof_contigs, ci)
+                bits['G'] |= get_bitset(g_pos, nof_contigs, ci)
+                bits['T'] |= get_bitset(t_pos, nof_contigs, ci)
+                bits['N'] |= get_bitset(n_pos, nof_contigs, ci) | get_bitset(gap_pos, nof_contigs, ci)
+            var_cur.close()
+            for samid, bits in packed.items():
+                variants[samid] = encode_genotype(bits)
+
+            if oArgs.cache != None:
+                write_cache(oArgs.cache, sorted(contigs.keys()), variants)
+                logging.debug("%i variant sets written to cache %s.", len(variants), oArgs.cache)
 
         logging.debug("%i variant sets found.", len(variants))
 
@@ -134,24 +482,14 @@ def main():
 
     logging.debug("Calculating distances...")
 
-    distances = []
-    for samid, sam_name in samples.iteritems():
-        d = 0
-        for c_id, c_nme in contigs.iteritems():
-            d += len(((variants[samid][c_id]['A'] ^ data['positions'][c_nme]['A']) |
-                      (variants[samid][c_id]['C'] ^ data['positions'][c_nme]['C']) |
-                      (variants[samid][c_id]['G'] ^ data['positions'][c_nme]['G']) |
-                      (variants[samid][c_id]['T'] ^ data['positions'][c_nme]['T'])) \
-                     - (variants[samid][c_id]['N'] | data['positions'][c_nme]['N'] | data['positions'][c_nme]['-']))
-
-        distances.append((samid, sam_name, d))
-
-    distances.sort(key=lambda x: x[2])
+    # all positions are held as genome wide integer bitsets, so the set operations work on
+    # whole machine words at a time and there is one evaluation per sample for all contigs
+    distances = calculate_distances_parallel(samples, variants, query, oArgs.processes)
+    distances.sort(key=itemgetter(2))
 
     resu = {'sample_name': oArgs.sam_name_in, 'distances': distances}
     outfilename = '%s.distances.json.gz' % (oArgs.sam_name_in)
-    with gzip.open(outfilename, 'w') as outfile:
-        json.dump(resu, outfile)
+    write_json_gz(resu, outfilename)
 
     logging.debug("Written %i distances to file %s", len(distances), outfilename)
 
@@ -6,7 +6,9 @@ import sys
 import logging
 from datetime import datetime
 
-from lib.distances import get_distances
+from psycopg2.extras import execute_values, execute_batch
+
+from lib.distances import get_mean_distances
 
 __version__= '0.1'
 __date__= '14Jul2017'
@@ -66,15 +68,9 @@ class ClusterMerge(object):
         0
         '''
 
-        self.member_stats = {}
-
         logging.info("Calculating mean distance of all members of merging cluster %s on level %s.", self.final_name, self.t_level)
 
-        for fm in self.final_members:
-            others = [x for x in self.final_members if x != fm]
-            dists = get_distances(cur, fm, others)
-            x = [d for (s, d) in dists]
-            self.member_stats[fm] = sum(x) / float(len(x))
+        self.member_stats = get_mean_distances(cur, self.final_members)
 
         return 0
 
@@ -114,14 +110,14 @@ class ClusterMerge(object):
         logging.warning("The clusters %s on level %s have been MERGED into cluster %s and have been DELETED.", str(list(clu_to_del)), self.t_level, self.final_name)
 
         nownow = datetime.now()
-        for source in clu_to_del:
-            sql = "INSERT INTO merge_log (cluster_level, source_cluster, target_cluster, time_of_merge) VALUES (%s, %s, %s, %s)"
-            cur.execute(sql, (self.t_level, source, self.final_name, nownow, ))
+        sql = "INSERT INTO merge_log (cluster_level, source_cluster, target_cluster, time_of_merge) VALUES %s"
+        execute_values(cur, sql, [(self.t_level, source, self.final_name, nownow) for source in clu_to_del])
 
         # write to the log which samples get changed from what to what
         sql = "SELECT s.pk_id, s.sample_name, c.t0, c.t5, c.t10, c.t25, c.t50, c.t100, c.t250 FROM samples s, sample_clusters c WHERE s.pk_id=c.fk_sample_id AND c."+self.t_level+" IN %s"
         cur.execute(sql , (tuple([x for x in self.org_clusters if x != self.final_name]), ))
         rows = cur.fetchall()
+        history = []
         for r in rows:
             logging.warning("Clustering for sample %s will be changed from %s to %s",
                             r['sample_name'],
@@ -129,24 +125,25 @@ class ClusterMerge(object):
                             '-'.join([str(self.final_name) if x == self.t_level else str(r[x]) for x in levels]))
 
             # also write this to a table
-            sql = "INSERT INTO sample_history (fk_sample_id, t250_old, t100_old, t50_old, t25_old, t10_old, t5_old, t0_old, t250_new, t100_new, t50_new, t25_new, t10_new, t5_new, t0_new, renamed_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-            cur.execute(sql ,(r['pk_id'], \
-                              r['t250'], r['t100'], r['t50'], r['t25'], r['t10'], r['t5'], r['t0'], \
-                              self.final_name if self.t_level == 't250' else r['t250'], \
-                              self.final_name if self.t_level == 't100' else r['t100'], \
-                              self.final_name if self.t_level == 't50' else r['t50'], \
-                              self.final_name if self.t_level == 't25' else r['t25'], \
-                              self.final_name if self.t_level == 't10' else r['t10'], \
-                              self.final_name if self.t_level == 't5' else r['t5'], \
-                              self.final_name if self.t_level == 't0' else r['t0'], \
-                              nownow, ))
+            history.append((r['pk_id'], \
+                            r['t250'], r['t100'], r['t50'], r['t25'], r['t10'], r['t5'], r['t0'], \
+                            self.final_name if self.t_level == 't250' else r['t250'], \
+                            self.final_name if self.t_level == 't100' else r['t100'], \
+                            self.final_name if self.t_level == 't50' else r['t50'], \
+                            self.final_name if self.t_level == 't25' else r['t25'], \
+                            self.final_name if self.t_level == 't10' else r['t10'], \
+                            self.final_name if self.t_level == 't5' else r['t5'], \
+                            self.final_name if self.t_level == 't0' else r['t0'], \
+                            nownow))
+
+        sql = "INSERT INTO sample_history (fk_sample_id, t250_old, t100_old, t50_old, t25_old, t10_old, t5_old, t0_old, t250_new, t100_new, t50_new, t25_new, t10_new, t5_new, t0_new, renamed_at) VALUES %s"
+        execute_values(cur, sql, history, page_size=500)
 
         sql = "UPDATE sample_clusters SET "+self.t_level+"=%s WHERE "+self.t_level+" IN %s"
         cur.execute(sql, (self.final_name, tuple(self.org_clusters), ))
 
-        for fm in self.final_members:
-            sql = "UPDATE sample_clusters SET "+self.t_level+"_mean=%s WHERE fk_sample_id=%s"
-            cur.execute(sql, (self.member_stats[fm], fm, ))
+        sql = "UPDATE sample_clusters SET "+self.t_level+"_mean=%s WHERE fk_sample_id=%s"
+        execute_batch(cur, sql, [(self.member_stats[fm], fm) for fm in self.final_members], page_size=500)
 
         return 0
 
@@ -39,7 +39,7 @@ class ClusterStats(object):
         self.stddev_pw_dist = None
         self.variance_pw_dist = None
 
-        if kwargs.has_key('dists'):
+        if 'dists' in kwargs:
 
             self.nof_pw_dists = len(kwargs['dists'])
 
@@ -47,19 +47,19 @@ class ClusterStats(object):
                 raise ClusterStatsError("Nof members and nof distances inconsistent.")
 
             if self.nof_pw_dists > 0:
-                self.mean_pw_dist = float(sum(kwargs['dists']))/self.nof_pw_dists
-                #calculate variance and stddev
-                x = []
-                for d in kwargs['dists']:
-                    x.append((d - self.mean_pw_dist)**2.0)
-
-                self.variance_pw_dist = sum(x)/len(x)
+                n = self.nof_pw_dists
+                sm = sum(kwargs['dists'])
+                self.mean_pw_dist = float(sm)/n
+                #calculate variance and stddev from the sum of squares, the distances are
+                # ints so n*sum(d^2) - sum(d)^2 is exact and there is no cancellation
+                sq = sum(d*d for d in kwargs['dists'])
+                self.variance_pw_dist = float(n*sq - sm*sm)/(n*n)
                 self.stddev_pw_dist = math.sqrt(self.variance_pw_dist)
             else:
                 # this is for one member or 0 member clusters only clusters
                 pass
 
-        elif kwargs.has_key('stddev') and kwargs.has_key('mean'):
+        elif 'stddev' in kwargs and 'mean' in kwargs:
             self.nof_pw_dists = (self.members * (self.members-1))/2.0
             if self.members > 0:
                 self.mean_pw_dist = float(kwargs['mean'])
@@ -91,26 +91,21 @@ class ClusterStats(object):
         assert len(new_dists) == self.members
 
         if self.members > 1:
-            for nd in new_dists:
-                # remember the mean before updating
-                prev_m = self.mean_pw_dist
-
-                # proxy for the sum of all pw dists
-                sm = self.mean_pw_dist * float(self.nof_pw_dists)
-                # add one new dist to the sum
-                new_sum = sm + nd
-                # we have one more dist at this point
-                self.nof_pw_dists += 1
-                # new mean is new_sum over new nof dists
-                self.mean_pw_dist = new_sum / self.nof_pw_dists
-
-                # update the variance
-                # see https://math.stackexchange.com/questions/775391
-                N = self.nof_pw_dists
-                a = (N - 1) * (self.variance_pw_dist)
-                b = (nd - self.mean_pw_dist) * (nd - prev_m)
-                self.variance_pw_dist = (a + b) / N
-                self.stddev_pw_dist = math.sqrt(self.variance_pw_dist)
+            # combine the stats for the existing dists with the stats for the batch of new dists
+            # see https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+            n_a = self.nof_pw_dists
+            n_b = len(new_dists)
+            mean_b = float(sum(new_dists)) / n_b
+            m2_b = sum((nd - mean_b)**2 for nd in new_dists)
+
+            N = n_a + n_b
+            delta = mean_b - self.mean_pw_dist
+            m2 = (self.variance_pw_dist * n_a) + m2_b + (delta**2 * n_a * n_b / N)
+
+            self.nof_pw_dists = N
+            self.mean_pw_dist += delta * n_b / N
+            self.variance_pw_dist = m2 / N
+            self.stddev_pw_dist = math.sqrt(self.variance_pw_dist)
         elif self.members == 1:
             self.nof_pw_dists = 1
             self.mean_pw_dist = float(new_dists[0])
@@ -9,14 +9,21 @@ import logging
 import subprocess
 import sys
 import tempfile
-import os
-import shutil
+from collections import OrderedDict
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 import psycopg2
 from psycopg2.extras import DictCursor
+from psycopg2.extensions import make_dsn
+from psycopg2.sql import SQL, Identifier
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 
-from lib.distances import get_distances, get_relevant_distances, get_distance_matrix
+from lib.distances import get_distances, get_relevant_distances, get_distance_matrix, get_distance_matrix_cached, complete_distance_matrix
 from lib.utils import get_closest_threshold
+from lib.alignment import close_pool as close_alignment_pool
 
 import get_alignment
 
@@ -29,6 +36,20 @@ except ImportError:
 
 # --------------------------------------------------------------------------------------------------
 
+# statements that are prepared once per database session, name: (argument types, statement)
+PREPARED_STATEMENTS = {'snad_by_name': ('text', "SELECT s.pk_id, c.t0, c.t5, c.t10, c.t25, c.t50, c.t100, c.t250 FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.sample_name=$1")}
+for _lvl in [0, 5, 10, 25, 50, 100, 250]:
+    PREPARED_STATEMENTS['cluster_members_t%i' % (_lvl)] = \
+        ('integer', "SELECT fk_sample_id FROM sample_clusters WHERE t%i=$1" % (_lvl))
+# sizes of the clusters of a snp address on all levels, arguments are the snp address t0 first,
+# each level is counted on its own, so this doesn't rely on the clusters being nested, and every
+# count is an index only scan on that level's index
+PREPARED_STATEMENTS['cluster_sizes'] = \
+    (", ".join(["integer"] * 7),
+     "SELECT " + ", ".join(["(SELECT count(*) FROM sample_clusters WHERE t%i=$%i) AS n%i" % (_lvl, _i+1, _lvl) for _i, _lvl in enumerate([0, 5, 10, 25, 50, 100, 250])]))
+
+# --------------------------------------------------------------------------------------------------
+
 class SnapperDBInterrogationError(Exception):
     pass
 
@@ -41,6 +62,68 @@ class SnapperDBInterrogation(object):
 
     """
 
+    # connection pool shared by all instances, see init_pool()
+    _pool = None
+    _pool_connstring = None
+
+    # maximum number of snp addresses remembered per connection, see _fetch_snad_samid()
+    SNAD_CACHE_SIZE = 4096
+    # maximum number of clusters whose members are remembered per connection, see _fetch_cluster_members()
+    MEMBERS_CACHE_SIZE = 1024
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @classmethod
+    def init_pool(cls, minconn, maxconn, conn_string):
+        """
+        Create a pool of database connections that is shared by all instances of this class
+        that use the same connection string. Without a pool every context manager opens and
+        closes its own connection.
+
+        Parameters
+        ----------
+        minconn: int
+            number of connections opened straight away
+        maxconn: int
+            maximum number of connections, keep this to a few dozen at most
+        conn_string: str
+            connection string for the database
+
+        Returns
+        -------
+        None
+        """
+
+        # only replace this class's pool, the alignment connections may still be in use
+        if cls._pool != None:
+            cls._pool.closeall()
+        cls._pool = None
+        cls._pool_connstring = None
+        try:
+            cls._pool = ThreadedConnectionPool(minconn, maxconn, conn_string)
+            cls._pool_connstring = conn_string
+        except psycopg2.OperationalError as ex:
+            raise SnapperDBInterrogationError(str(ex))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @classmethod
+    def close_pool(cls):
+        """
+        Close all connections in the pool, if there is one, and the connections that
+        get_alignment opened through lib.alignment.
+
+        Returns
+        -------
+        None
+        """
+
+        if cls._pool != None:
+            cls._pool.closeall()
+        cls._pool = None
+        cls._pool_connstring = None
+        close_alignment_pool()
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
     def __init__(self, **kwargs):
@@ -52,34 +135,102 @@ class SnapperDBInterrogation(object):
 
         """
 
-        self.connstring = None
+        self.conn_kwargs = None
+        self.snad_cache = OrderedDict()
+        self.members_cache = OrderedDict()
 
-        if kwargs.has_key('conn_string'):
-            self.connstring = kwargs['conn_string']
-        elif all(kwargs.has_key(x) for x in ["host", "dbname", "user", "password"]) == True:
-            self.connstring = "host='%s' dbname='%s' user='%s' password='%s'" % \
-                              (kwargs["host"],
-                               kwargs["dbname"],
-                               kwargs["user"],
-                               kwargs["password"])
+        if 'conn_string' in kwargs:
+            self.conn_kwargs = {'dsn': kwargs['conn_string']}
+        elif all(x in kwargs for x in ["host", "dbname", "user", "password"]):
+            # passed to psycopg2 as they are, so quotes in passwords etc. don't need escaping
+            self.conn_kwargs = {x: kwargs[x] for x in ["host", "dbname", "user", "password"]}
         else:
             raise SnapperDBInterrogationError("kwargs combination passed to constructor not valid.")
 
+        # a properly quoted connection string, needed for the pool and for get_alignment
+        try:
+            self.connstring = make_dsn(**self.conn_kwargs)
+        except psycopg2.ProgrammingError as ex:
+            raise SnapperDBInterrogationError(str(ex))
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
     def _connect(self):
         """
         **PRIVATE**
 
-        Connect to the external database for querying.
+        Connect to the external database for querying. Takes a connection from the pool
+        if there is one for this database.
         """
 
+        self.pooled = self._pool != None and self._pool_connstring == self.connstring
+
         try:
-            self.conn = psycopg2.connect(self.connstring)
-            self.cur = self.conn.cursor(cursor_factory=DictCursor)
-        except psycopg2.OperationalError as ex:
+            if self.pooled == True:
+                self.conn = self._pool.getconn()
+            else:
+                self.conn = psycopg2.connect(**self.conn_kwargs)
+        except (psycopg2.Error, PoolError) as ex:
             raise SnapperDBInterrogationError(str(ex))
 
+        try:
+            self.cur = self.conn.cursor(cursor_factory=DictCursor)
+            # plain tuple rows for queries that return lots of rows
+            self.fast_cur = self.conn.cursor()
+            # prepared on first use, see _execute_prepared()
+            self.prepared = False
+        except Exception as ex:
+            # __exit__ is not called when __enter__ fails, so the connection has to go back here
+            if self.pooled == True:
+                self._pool.putconn(self.conn, close=True)
+            else:
+                self.conn.close()
+            if isinstance(ex, psycopg2.Error):
+                raise SnapperDBInterrogationError(str(ex))
+            raise
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _prepare_statements(self):
+        """
+        **PRIVATE**
+
+        Prepare the statements that are run over and over again, so the database parses
+        and plans them once per session. Pooled connections keep their prepared statements,
+        so only the ones not yet known to this session are prepared, all in one go.
+        """
+
+        self.cur.execute("SELECT name FROM pg_prepared_statements")
+        have = set([r['name'] for r in self.cur.fetchall()])
+        missing = ["PREPARE %s (%s) AS %s" % (name, argtypes, stmt) for name, (argtypes, stmt) in PREPARED_STATEMENTS.items() if name not in have]
+        if len(missing) > 0:
+            self.cur.execute("; ".join(missing))
+        self.prepared = True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _execute_prepared(self, cur, name, args):
+        """
+        **PRIVATE**
+
+        Execute one of the PREPARED_STATEMENTS on the given cursor. They are prepared the
+        first time any of them is needed on this connection, so connections that never
+        use them, e.g. for making trees, don't pay for preparing them.
+
+        Parameters
+        ----------
+        cur: obj
+            cursor of this connection to execute on
+        name: str
+            name of the statement in PREPARED_STATEMENTS
+        args: tuple or list
+            arguments for the statement
+        """
+
+        if self.prepared == False:
+            self._prepare_statements()
+        cur.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(args))), args)
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
     def _close(self):
@@ -89,12 +240,22 @@ class SnapperDBInterrogation(object):
         Close the connection to the external database.
 
         There is no "commit" here because we will not be writing anything to the database.
+        Pooled connections are returned to the pool rather than closed.
 
         """
 
+        # the snp addresses might change while we're not looking
+        self.snad_cache.clear()
+        self.members_cache.clear()
+
         if not self.cur.closed:
             self.cur.close()
-        if self.conn.closed == 0:
+        if not self.fast_cur.closed:
+            self.fast_cur.close()
+        if self.pooled == True:
+            # the pool rolls back anything left open before handing the connection out again
+            self._pool.putconn(self.conn)
+        elif self.conn.closed == 0:
             self.conn.close()
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -124,6 +285,85 @@ class SnapperDBInterrogation(object):
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+    def _fetch_snad_samid(self, sam_name):
+        """
+        **PRIVATE**
+
+        Get the sample id and the snp address of a sample. The result is remembered for the
+        lifetime of the connection, so repeated queries for the same sample don't go to the
+        database again.
+
+        Parameters
+        ----------
+        sam_name: str
+            name of the query sample
+
+        Returns
+        -------
+        samid: int
+            the pk_id of the sample
+        snad: list of ints
+            [t0, t5, t10, t25, t50, t100, t250]
+        snad_str: str
+            "1.2.3.4.5.6.7", i.e. t250 first
+        """
+
+        try:
+            res = self.snad_cache.pop(sam_name)
+        except KeyError:
+            self._execute_prepared(self.cur, "snad_by_name", (sam_name, ))
+            if self.cur.rowcount < 1:
+                raise SnapperDBInterrogationError("No clustering information found for sample %s" % (sam_name))
+            elif self.cur.rowcount > 1:
+                raise SnapperDBInterrogationError("Too much clustering information found for sample %s" % (sam_name))
+            row = self.cur.fetchone()
+            snad = [row['t0'], row['t5'], row['t10'], row['t25'], row['t50'], row['t100'], row['t250']]
+            res = (row['pk_id'], snad, '.'.join([str(x) for x in snad[::-1]]))
+            if len(self.snad_cache) >= self.SNAD_CACHE_SIZE:
+                # drop the least recently used one
+                self.snad_cache.popitem(last=False)
+
+        # (re-)insert as most recently used
+        self.snad_cache[sam_name] = res
+        return res
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _fetch_cluster_members(self, lvl, cluster):
+        """
+        **PRIVATE**
+
+        Get the ids of all members of a cluster. The result is remembered for the lifetime of
+        the connection, because related query samples share their clusters.
+
+        Parameters
+        ----------
+        lvl: int
+            cluster level, one of 0, 5, 10, 25, 50, 100, 250
+        cluster: int
+            cluster name on that level
+
+        Returns
+        -------
+        members: tuple of ints
+            sample ids of the members
+        """
+
+        try:
+            members = self.members_cache.pop((lvl, cluster))
+        except KeyError:
+            self._execute_prepared(self.fast_cur, "cluster_members_t%i" % (lvl), (cluster, ))
+            members = tuple([r[0] for r in self.fast_cur])
+            if len(self.members_cache) >= self.MEMBERS_CACHE_SIZE:
+                # drop the least recently used one
+                self.members_cache.popitem(last=False)
+
+        # (re-)insert as most recently used
+        self.members_cache[(lvl, cluster)] = members
+        return members
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
     def get_closest_samples(self, sam_name, neighbours, levels=[0, 5, 10, 25, 50, 100, 250]):
         """
         Get the closest n samples.
@@ -145,47 +385,30 @@ class SnapperDBInterrogation(object):
         """
 
         # get the snp address of the query sample
-        sql = "SELECT s.pk_id, c.t0, c.t5, c.t10, c.t25, c.t50, c.t100, c.t250 FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.sample_name=%s"
-        self.cur.execute(sql,(sam_name, ))
-        if self.cur.rowcount < 1:
-            raise SnapperDBInterrogationError("No clustering information found for sample %s" % (sam_name))
-        row = self.cur.fetchone()
-        snad = [row['t0'], row['t5'], row['t10'], row['t25'], row['t50'], row['t100'], row['t250']]
-        samid = row['pk_id']
-
-        close_samples = set()
-        id2name = {}
-        for clu, lvl in zip(snad, levels):
-
-            t_lvl = 't%i' % (lvl)
-            sql = "SELECT s.sample_name, c.fk_sample_id FROM sample_clusters c, samples s WHERE c."+t_lvl+"=%s AND s.pk_id=c.fk_sample_id"
-            self.cur.execute(sql, (clu, ))
-            rows = self.cur.fetchall()
-            for r in rows:
-                id2name[r['fk_sample_id']] = r['sample_name']
-                if r['fk_sample_id'] != samid:
-                    close_samples.add(r['fk_sample_id'])
+        (samid, snad, _) = self._fetch_snad_samid(sam_name)
 
-            logging.info("Number of samples in same %s cluster: %i.", t_lvl, len(close_samples))
+        # count the members of the query sample's clusters on all levels in one go
+        self._execute_prepared(self.cur, "cluster_sizes", snad)
+        row = self.cur.fetchone()
 
-            if len(close_samples) >= neighbours:
+        # only get the members of the lowest level cluster that has enough samples in it
+        close_samples = []
+        for lvl in levels:
+            # the query sample itself is in the count
+            logging.info("Number of samples in same t%i cluster: %i.", lvl, row['n%i' % (lvl)] - 1)
+            if row['n%i' % (lvl)] - 1 >= neighbours:
+                members = self._fetch_cluster_members(lvl, snad[levels.index(lvl)])
+                close_samples = [x for x in members if x != samid]
                 break
 
+        # the closest n samples and any that are as far away as the nth one
         distances = None
         if len(close_samples) < neighbours:
-            distances = get_relevant_distances(self.cur, samid)
-            sql = "SELECT pk_id, sample_name FROM samples"
-            self.cur.execute(sql)
-            id2name = {r['pk_id']: r['sample_name'] for r in self.cur.fetchall()}
+            distances = get_relevant_distances(self.fast_cur, samid, with_names=True, limit_with_ties=neighbours)
         else:
-            distances = get_distances(self.cur, samid, list(close_samples))
-        result_samples = distances[:neighbours]
+            distances = get_distances(self.fast_cur, samid, close_samples, with_names=True, limit_with_ties=neighbours)
 
-        for (sa, di) in distances[neighbours:]:
-            if di == result_samples[-1][1]:
-                result_samples.append((sa, di))
-
-        result_samples = [(id2name[sa], di) for (sa, di) in result_samples if sa != samid]
+        result_samples = [(sa, di) for (sa, di) in distances if sa != sam_name]
         return result_samples
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -211,41 +434,29 @@ class SnapperDBInterrogation(object):
         """
 
         # get the snp address of the query sample
-        sql = "SELECT s.pk_id, c.t0, c.t5, c.t10, c.t25, c.t50, c.t100, c.t250 FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.sample_name=%s"
-        self.cur.execute(sql,(sam_name, ))
-        if self.cur.rowcount < 1:
-            raise SnapperDBInterrogationError("No clustering information found for sample %s" % (sam_name))
-        row = self.cur.fetchone()
-        snad = [row['t0'], row['t5'], row['t10'], row['t25'], row['t50'], row['t100'], row['t250']]
-        samid = row['pk_id']
+        (samid, snad, _) = self._fetch_snad_samid(sam_name)
 
         ct = get_closest_threshold(dis)
         if ct != None:
             # selected distance <250 -> use only samples in associated cluster for calculation
-            t_ct = 't%i' % (ct)
-            cluster = snad[levels.index(ct)]
-            sql = "SELECT s.sample_name AS samname, c.fk_sample_id AS samid FROM sample_clusters c, samples s WHERE c."+t_ct+"=%s AND s.pk_id=c.fk_sample_id"
-            self.cur.execute(sql, (cluster, ))
+            members = self._fetch_cluster_members(ct, snad[levels.index(ct)])
+            neighbours = [x for x in members if x != samid]
         else:
             # selected distance >250 -> use all samples that have been clustered and are not ignored for calculation
-            sql = "SELECT s.sample_name AS samname, c.fk_sample_id AS samid FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.ignore_sample IS FALSE AND s.sample_name<>%s"
-            self.cur.execute(sql, (sam_name, ))
-
-        id2name = {}
-        rows = self.cur.fetchall()
-        neighbours = []
-        for r in rows:
-            id2name[r['samid']] = r['samname']
-            if r['samid'] != samid:
-                neighbours.append(r['samid'])
+            # this is a scan of the whole table, so stream it through a server side cursor in batches
+            sql = "SELECT c.fk_sample_id FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.ignore_sample IS FALSE AND s.sample_name<>%s"
+            scan_cur = self.conn.cursor(name='samples_scan')
+            scan_cur.itersize = 1000
+            scan_cur.execute(sql, (sam_name, ))
+            neighbours = [r[0] for r in scan_cur if r[0] != samid]
+            scan_cur.close()
 
         if len(neighbours) <= 0:
             logging.info("No samples found this close to the query sample.")
             return []
         else:
             logging.info("Calculating distances to %i samples.", len(neighbours))
-            distances = get_distances(self.cur, samid, neighbours)
-            result_samples = [(id2name[s], d) for (s, d) in distances if d <= dis]
+            result_samples = get_distances(self.fast_cur, samid, neighbours, with_names=True, max_dist=dis)
             if len(result_samples) <= 0:
                 logging.info("No samples found this close to the query sample.")
             return result_samples
@@ -267,15 +478,8 @@ class SnapperDBInterrogation(object):
             "1.2.3.4.5.6.7" if successful else None
         """
 
-        sql = "SELECT c.t0, c.t5, c.t10, c.t25, c.t50, c.t100, c.t250 FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.sample_name=%s"
-        self.cur.execute(sql, (sam_name, ))
-        if self.cur.rowcount < 1:
-            raise SnapperDBInterrogationError("No clustering information found for sample %s" % (sam_name))
-        elif self.cur.rowcount > 1:
-            raise SnapperDBInterrogationError("Too much clustering information found for sample %s" % (sam_name))
-        else:
-            row = self.cur.fetchone()
-            return "%i.%i.%i.%i.%i.%i.%i" % (row['t250'], row['t100'], row['t50'], row['t25'], row['t10'], row['t5'], row['t0'])
+        (_, _, snad_str) = self._fetch_snad_samid(sam_name)
+        return snad_str
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -294,21 +498,15 @@ class SnapperDBInterrogation(object):
             e.g.: 100>=x>50
         """
 
-        sql = "SELECT c.t0, c.t5, c.t10, c.t25, c.t50, c.t100, c.t250 FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.sample_name=%s"
-        self.cur.execute(sql, (sam_name, ))
-        if self.cur.rowcount < 1:
-            raise SnapperDBInterrogationError("No clustering information found for sample %s" % (sam_name))
-        elif self.cur.rowcount > 1:
-            raise SnapperDBInterrogationError("Too much clustering information found for sample %s" % (sam_name))
-        else:
-            row = self.cur.fetchone()
+        (_, snad, _) = self._fetch_snad_samid(sam_name)
 
+        # count the cluster sizes on all levels in one go
         levels = [250, 100, 50, 25, 10, 5, 0]
+        self._execute_prepared(self.cur, "cluster_sizes", snad)
+        row = self.cur.fetchone()
+
         for lvl in levels:
-            t_lvl = 't%i' % (lvl)
-            sql = "SELECT pk_id FROM sample_clusters WHERE " + t_lvl + "=%s"
-            self.cur.execute(sql, (row[t_lvl], ))
-            if self.cur.rowcount == 1:
+            if row['n%i' % (lvl)] == 1:
                 if lvl == 250:
                     nearest = "x>250"
                 else:
@@ -340,19 +538,9 @@ class SnapperDBInterrogation(object):
                          ...]}
         """
 
-        sql = "SELECT s.pk_id, c.t0, c.t5, c.t10, c.t25, c.t50, c.t100, c.t250 \
-               FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.sample_name=%s"
-        self.cur.execute(sql, (sam_name, ))
-        if self.cur.rowcount < 1:
-            raise SnapperDBInterrogationError("No clustering information found for sample %s" % (sam_name))
-        elif self.cur.rowcount > 1:
-            raise SnapperDBInterrogationError("Too much clustering information found for sample %s" % (sam_name))
-        else:
-            row = self.cur.fetchone()
-
-        sam_id = row['pk_id']
+        (sam_id, _, snad_str) = self._fetch_snad_samid(sam_name)
         levels = [250, 100, 50, 25, 10, 5, 0]
-        res = {'current_snad': '.'.join([str(row['t%i' % (lvl)]) for lvl in levels]),
+        res = {'current_snad': snad_str,
                'history': []}
 
         sql = "SELECT t0_old, t5_old, t10_old, t25_old, t50_old, t100_old, t250_old, t0_new, \
@@ -380,6 +568,16 @@ class SnapperDBInterrogation(object):
             {'lvl': [1,2,3], 'lvl': [2,5,8]}
         method: str
             either 'ML' or 'NJ'
+        kwargs:
+            dm: str
+                NJ only, store the distance matrix as csv in this file or None
+            dist_cache: str
+                NJ only, sqlite file to keep the distances in between calls [optional]
+            prefetched_distances: dict
+                NJ only, distances the caller already has, e.g. from get_closest_samples,
+                {sam name: {sam name: distance, ...}, ...}, only the rest is calculated [optional]
+            ref, refname, rmref:
+                ML only, reference file, its name in the database and whether to remove it
 
         Returns
         -------
@@ -387,15 +585,15 @@ class SnapperDBInterrogation(object):
 
         """
 
+        cur = self.fast_cur
         treesams = {}
 
         if samples != None:
 
-            sql = "SELECT pk_id, sample_name FROM samples WHERE sample_name IN %s"
-            self.cur.execute(sql, (tuple(samples), ))
-            rows = self.cur.fetchall()
-            for r in rows:
-                treesams[r['sample_name']] = r['pk_id']
+            # one array parameter rather than a literal IN list with hundreds of names
+            sql = "SELECT sample_name, pk_id FROM samples WHERE sample_name = ANY(%s)"
+            cur.execute(sql, (list(samples), ))
+            treesams.update(cur.fetchall())
 
             missing = set(samples).difference(set(treesams.keys()))
             if len(missing) > 0:
@@ -406,33 +604,27 @@ class SnapperDBInterrogation(object):
         if clusters != None:
             for t_lvl, clusterlist in clusters.items():
                 try:
-                    sql = "SELECT c.fk_sample_id AS id, s.sample_name AS name FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND c."+t_lvl+" IN %s"
-                    self.cur.execute(sql, (tuple(clusterlist), ))
-                    rows = self.cur.fetchall()
-                    for r in rows:
-                        treesams[r['name']] = r['id']
+                    # the level comes from the caller, so it is quoted as an identifier
+                    sql = SQL("SELECT s.sample_name, c.fk_sample_id FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND c.{} = ANY(%s::integer[])").format(Identifier(t_lvl))
+                    cur.execute(sql, (list(clusterlist), ))
+                    treesams.update(cur.fetchall())
                 except psycopg2.ProgrammingError as e:
                     raise SnapperDBInterrogationError(e)
 
-        nofsams = len(treesams.keys())
+        nofsams = len(treesams)
         if nofsams < 3:
             raise SnapperDBInterrogationError("At least 3 samples are required to make a tree. Only %i found." % nofsams)
-        elif nofsams > 400:
-            if kwargs.has_key('overwrite_max') == True and kwargs['overwrite_max'] == True:
-                pass
-            else:
-                raise SnapperDBInterrogationError("This tree would contain %i samples. A maximum of 400 is permitted. Please select a more targeted subset." % nofsams)
-        else:
-            pass
+        elif nofsams > 400 and not kwargs.get('overwrite_max'):
+            raise SnapperDBInterrogationError("This tree would contain %i samples. A maximum of 400 is permitted. Please select a more targeted subset." % nofsams)
 
         logging.info("Calculating %s tree for %i samples.", method, nofsams)
 
         if method == 'NJ':
-            if HAVE_BIOPYTHON == False:
+            if not HAVE_BIOPYTHON:
                 raise SnapperDBInterrogationError("You need to have Biopython for making NJ trees.")
-            return self._make_nj_tree(treesams, kwargs['dm'])
+            return self._make_nj_tree(treesams, kwargs['dm'], kwargs.get('dist_cache'), kwargs.get('prefetched_distances'))
         elif method == 'ML':
-            if self._can_we_make_an_ml_tree() == False:
+            if not self._can_we_make_an_ml_tree():
                 raise SnapperDBInterrogationError("You need to have FastTree for making ML trees.")
             return self._make_ml_tree(treesams, kwargs['ref'], kwargs['refname'], kwargs['rmref'])
         else:
@@ -440,7 +632,7 @@ class SnapperDBInterrogation(object):
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-    def _make_nj_tree(self, treesams, dm):
+    def _make_nj_tree(self, treesams, dm, dist_cache=None, prefetched_distances=None):
         """
         **PRIVATE**
 
@@ -448,6 +640,12 @@ class SnapperDBInterrogation(object):
         ----------
         treesams: dict
             {sam name: samid, sam name: samid, ...}
+        dm: str
+            store the distance matrix as csv in this file or None
+        dist_cache: str
+            sqlite file to keep the distances in between calls or None
+        prefetched_distances: dict
+            {sam name: {sam name: distance, ...}, ...} or None
 
         Returns
         -------
@@ -458,44 +656,51 @@ class SnapperDBInterrogation(object):
         iNofSams = len(treesams.keys())
         logging.info("Calculating %i distances. Patience!", ((iNofSams**2) - iNofSams) / 2)
 
-        dist_mat = get_distance_matrix(self.cur, treesams.values())
-
-        if dm != None:
-            logging.info("Distance matrix written to file: %s", dm)
-            if os.path.exists(dm) == True:
-                os.remove(dm)
+        # translate whatever the caller already has to ids, both ways round
+        known = {}
+        if prefetched_distances != None:
+            for sam_a, row in prefetched_distances.items():
+                for sam_b, d in row.items():
+                    if sam_a in treesams and sam_b in treesams:
+                        known.setdefault(treesams[sam_a], {})[treesams[sam_b]] = d
+                        known.setdefault(treesams[sam_b], {})[treesams[sam_a]] = d
+
+        if dist_cache != None:
+            dist_mat = get_distance_matrix_cached(self.cur, treesams.values(), dist_cache, known=known)
+        elif len(known) > 0:
+            dist_mat = known
+            new = complete_distance_matrix(self.cur, treesams.values(), dist_mat)
+            logging.info("%i distances were provided, %i calculated.", ((iNofSams**2) - iNofSams) / 2 - len(new), len(new))
+        else:
+            dist_mat = get_distance_matrix(self.cur, treesams.values())
 
-        aSampleNames = treesams.keys()
+        aSampleNames = list(treesams.keys())
+        aSampleIds = [treesams[x] for x in aSampleNames]
         aSimpleMatrix = []
         for i, sample_1 in enumerate(aSampleNames):
-            mat_line = []
-            for j, sample_2 in enumerate(aSampleNames):
-                if j < i:
-                    sid1 = treesams[sample_1]
-                    sid2 = treesams[sample_2]
-                    mat_line.append(dist_mat[sid1][sid2])
-                elif j == i:
-                    mat_line.append(0)
-                else:
-                    pass
+            # lower triangle only, Biopython wants the diagonal included
+            dist_row = dist_mat[aSampleIds[i]]
+            mat_line = [dist_row[sid2] for sid2 in aSampleIds[:i]]
+            mat_line.append(0)
             aSimpleMatrix.append(mat_line)
-            if dm != None:
-                with open(dm, 'a') as f:
+
+        if dm != None:
+            # open once and overwrite, lines are the lower triangle without the diagonal
+            with open(dm, 'w') as f:
+                for sample_1, mat_line in zip(aSampleNames, aSimpleMatrix):
                     f.write("%s\n" % ','.join([sample_1] + [str(x) for x in mat_line[:-1]]))
+            logging.info("Distance matrix written to file: %s", dm)
 
         logging.info("Bulding tree.")
         oDistMat = TreeConstruction._DistanceMatrix(aSampleNames, aSimpleMatrix)
         constructor = TreeConstruction.DistanceTreeConstructor()
         oTree = constructor.nj(oDistMat)
 
-        # I don't know how to get newick string from this object without a file ...
-        td = tempfile.mkdtemp()
-        tmpfile = os.path.join(td, 'tree.nwk')
-        Phylo.write(oTree, tmpfile, 'newick')
-        nwkstring = ""
-        with open(tmpfile, 'r') as f:
-            nwkstring = f.read()
-        shutil.rmtree(td)
+        # Phylo writes to any file handle, so keep it in memory
+        nwk = StringIO()
+        Phylo.write(oTree, nwk, 'newick')
+        nwkstring = nwk.getvalue()
+        nwk.close()
 
         return nwkstring
 
@@ -517,9 +722,6 @@ class SnapperDBInterrogation(object):
 
         """
 
-        td = tempfile.mkdtemp()
-        tmpfile = os.path.join(td, 'align.fasta')
-
         inp = {'whole_genome': False,
                'snp_address': False,
                'remove_invariant_npos': True,
@@ -532,27 +734,44 @@ class SnapperDBInterrogation(object):
                'sample_gaps': None,
                'version': 'internal',
                'include': None,
-               'samples': treesams.keys(),
+               'samples': list(treesams.keys()),
                'exclude': None,
                'debug': False,
                'sample_Ns_gaps_auto_factor': 2.0,
+               'processes': 1,
                'name_of_ref_in_db': refname,
-               'out': tmpfile,
+               'out': None,
                'remove_ref': rmref}
 
-        if get_alignment.main(inp) != 0:
-            raise SnapperDBInterrogationError("Error in get_alignment main.")
-
-        cmd = "FastTree -nt %s" % (tmpfile)
-        logging.info("Running FastTree now. Patience.")
-        p = subprocess.Popen(cmd, shell=True, stdin=None,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, close_fds=True)
-        (p_out, p_err) = p.communicate()
-
-        logging.debug("FastTree stderr: %s", p_err)
-
-        shutil.rmtree(td)
+        # the alignment is written straight to FastTree's stdin, one sequence at a time, so it is
+        # never held as text, neither in a file nor in memory. FastTree's output goes to temporary
+        # files, so it can't fill up a pipe and block the writing.
+        with tempfile.TemporaryFile(mode='w+') as out_fp, tempfile.TemporaryFile(mode='w+') as err_fp:
+            p = subprocess.Popen(["FastTree", "-nt"], stdin=subprocess.PIPE,
+                                 stdout=out_fp,
+                                 stderr=err_fp, close_fds=True,
+                                 universal_newlines=True)
+            inp['out'] = p.stdin
+            try:
+                res = get_alignment.main(inp)
+                p.stdin.close()
+            except:
+                p.kill()
+                p.wait()
+                raise
+
+            if res != 0:
+                p.kill()
+                p.wait()
+                raise SnapperDBInterrogationError("Error in get_alignment main.")
+
+            logging.info("Running FastTree now. Patience.")
+            p.wait()
+
+            out_fp.seek(0)
+            p_out = out_fp.read()
+            err_fp.seek(0)
+            logging.debug("FastTree stderr: %s", err_fp.read())
 
         return p_out
 
@@ -575,7 +794,8 @@ class SnapperDBInterrogation(object):
 
         p = subprocess.Popen("which FastTree", shell=True, stdin=None,
                              stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, close_fds=True)
+                             stderr=subprocess.PIPE, close_fds=True,
+                             universal_newlines=True)
         (p_out, p_err) = p.communicate()
 
         flag = not "no FastTree in" in p_err
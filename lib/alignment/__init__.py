@@ -5,14 +5,106 @@ author: ulf.schaefer@phe.gov.uk
 
 """
 
+import atexit
 import logging
+import multiprocessing
 import os
 import sys
+import threading
+from bisect import bisect_right
+from collections import Counter
+from math import fsum, sqrt
 
 from lib.utils import read_fasta
 
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+# positions on a contig are dense integers, roaring bitmaps hold them in a fraction of the memory
+# of a set and do the set algebra on whole containers
+# unlike set, BitMap's in place operators (difference_update, intersection_update, ...) are not
+# guaranteed to take any iterable, a list, range or set can raise, so only ever pass them a PositionSet
+HAVE_PYROARING = True
+try:
+    from pyroaring import BitMap as PositionSet
+except ImportError:
+    HAVE_PYROARING = False
+    PositionSet = set
+
+# connections are kept for the next call with the same connection string, see _get_connection()
+# there is one pool per connection string, so no pool is closed while someone else uses it
+_pools = {}
+_pools_lock = threading.Lock()
+
+# --------------------------------------------------------------------------------------------------
+
+def _get_connection(db):
+    """
+    **PRIVATE**
+
+    Get a read only connection to the database from the module's pool, so that the
+    functions below don't connect and authenticate again every time they are called.
+
+    Parameters
+    ----------
+    db: str
+        database connection string
+
+    Returns
+    -------
+    conn: obj
+        database connection, give it back with _put_connection()
+    """
+
+    with _pools_lock:
+        pool = _pools.get(db)
+        if pool == None:
+            pool = _pools[db] = ThreadedConnectionPool(1, 4, db)
+
+    conn = pool.getconn()
+    # nothing is written here, so let the server know
+    conn.set_session(readonly=True)
+    return conn
+
+# --------------------------------------------------------------------------------------------------
+
+def _put_connection(db, conn):
+    """
+    **PRIVATE**
+
+    Give a connection back to the pool it came from. The pool rolls back anything left open.
+    """
+
+    with _pools_lock:
+        pool = _pools.get(db)
+
+    if pool != None:
+        pool.putconn(conn)
+    else:
+        # the pools have been closed in the meantime
+        conn.close()
+
+# --------------------------------------------------------------------------------------------------
+
+def close_pool():
+    """
+    Close all connections in the pools of this module. This is also done at exit.
+
+    Returns
+    -------
+    None
+    """
+
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+
+    for pool in pools:
+        pool.closeall()
+
+    return None
+
+atexit.register(close_pool)
 
 # --------------------------------------------------------------------------------------------------
 
@@ -37,13 +129,17 @@ def add_reference_data(ref, all_contig_data):
         logging.error("Contig names don't match between the database and the file passed in the --reference parameter.")
         return None
 
-    for contig, data in all_contig_data.iteritems():
-        data['reference'] = {'A': set(), 'C': set(), 'G': set(), 'T': set(), 'N': set(), '-': set()}
+    for contig, data in all_contig_data.items():
+        # every position only needs looking up once, no matter how many samples have it
+        all_pos = PositionSet()
         for sam in data.keys():
             for n in data[sam].keys():
-                for x in data[sam][n]:
-                    refbase = ref[contig][x-1].upper()
-                    data['reference'][refbase].add(x)
+                all_pos.update(data[sam][n])
+
+        refseq = ref[contig].upper()
+        data['reference'] = {'A': PositionSet(), 'C': PositionSet(), 'G': PositionSet(), 'T': PositionSet(), 'N': PositionSet(), '-': PositionSet()}
+        for x in all_pos:
+            data['reference'][refseq[x-1]].add(x)
 
     return 0
 
@@ -70,8 +166,10 @@ def get_data_from_db(db, samples_in, refname):
 
     try:
         # open db
-        conn = psycopg2.connect(db)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        conn = _get_connection(db)
+        # all rows here are read by position, so plain tuples will do
+        cur = conn.cursor()
+        var_cur = None
 
         sql  = "SELECT pk_id FROM samples WHERE sample_name=%s"
         cur.execute(sql, (refname, ))
@@ -80,10 +178,11 @@ def get_data_from_db(db, samples_in, refname):
             return None
         refid = cur.fetchone()[0]
 
-        sql = "SELECT pk_id, sample_name FROM samples WHERE sample_name IN %s"
-        cur.execute(sql, (tuple(samples_in), ))
-        rows = cur.fetchall()
-        samples = {r['pk_id']: r['sample_name'] for r in rows}
+        # one array parameter rather than a literal IN list with hundreds of names
+        sql = "SELECT pk_id, sample_name FROM samples WHERE sample_name = ANY(%s)"
+        cur.execute(sql, (list(samples_in), ))
+        # rows are (key, value) pairs already
+        samples = dict(cur.fetchall())
 
         miss = set(samples_in).difference(set(samples.values()))
 
@@ -95,40 +194,42 @@ def get_data_from_db(db, samples_in, refname):
 
         sql = "SELECT pk_id, name FROM contigs"
         cur.execute(sql)
-        rows = cur.fetchall()
-        contigs = {r['pk_id']: r['name'] for r in rows}
-
-        for con_id, con_name in contigs.iteritems():
-
-            all_contig_data[con_name] = {}
+        contigs = dict(cur.fetchall())
+
+        # get the positions ignored in the reference (n_pos) for all contigs from the db
+        sql = "SELECT fk_contig_id, n_pos FROM variants WHERE fk_sample_id=%s"
+        cur.execute(sql, (refid, ))
+        ref_ign_pos = {}
+        for (con_id, res) in cur.fetchall():
+            if con_id in ref_ign_pos:
+                logging.error("Not exactly one row found in variants for reference on contig id %s.", con_id)
+                return None
+            ref_ign_pos[con_id] = PositionSet() if res == None else PositionSet(res)
 
-            # get the positions on this contig ignored in the reference (n_pos) from the db
-            sql = "SELECT n_pos FROM variants WHERE fk_sample_id=%s AND fk_contig_id=%s"
-            cur.execute(sql, (refid, con_id, ))
-            if cur.rowcount != 1:
+        for con_id, con_name in contigs.items():
+            if con_id not in ref_ign_pos:
                 logging.error("Not exactly one row found in variants for reference on contig id %s.", con_id)
                 return None
-            res = cur.fetchone()[0]
-            if res == None:
-                ref_ign_pos = set()
-            else:
-                ref_ign_pos = set(res)
-
-            sql = "SELECT fk_sample_id, a_pos, c_pos, g_pos, t_pos, n_pos, gap_pos FROM variants WHERE fk_sample_id IN %s AND fk_contig_id=%s"
-            cur.execute(sql, (tuple(samples.keys()), con_id, ))
-            rows = cur.fetchall()
-            for r in rows:
-                sam_name = samples[r['fk_sample_id']]
-                all_contig_data[con_name][sam_name] = {}
-                all_contig_data[con_name][sam_name]['A'] = set(r['a_pos'])
-                all_contig_data[con_name][sam_name]['C'] = set(r['c_pos'])
-                all_contig_data[con_name][sam_name]['G'] = set(r['g_pos'])
-                all_contig_data[con_name][sam_name]['T'] = set(r['t_pos'])
-                all_contig_data[con_name][sam_name]['-'] = set(r['gap_pos'])
-                all_contig_data[con_name][sam_name]['N'] = set(r['n_pos'])
-                all_contig_data[con_name][sam_name]['N'].update(ref_ign_pos) # add reference ignore positions back in
-
-        conn.commit()
+            all_contig_data[con_name] = {}
+
+        # all contigs in one query, the rows are dispatched to their contig here
+        # these rows are wide, so use plain tuples rather than DictRows and unpack them
+        # and stream them through a server side cursor, so only itersize rows are held at a time
+        var_cur = conn.cursor(name='variants_stream')
+        var_cur.itersize = 64
+        sql = "SELECT fk_sample_id, fk_contig_id, a_pos, c_pos, g_pos, t_pos, n_pos, gap_pos FROM variants WHERE fk_sample_id = ANY(%s)"
+        var_cur.execute(sql, (list(samples.keys()), ))
+        for (fk_sample_id, con_id, a_pos, c_pos, g_pos, t_pos, n_pos, gap_pos) in var_cur:
+            sam_name = samples[fk_sample_id]
+            all_contig_data[contigs[con_id]][sam_name] = {'A': PositionSet(a_pos),
+                                                          'C': PositionSet(c_pos),
+                                                          'G': PositionSet(g_pos),
+                                                          'T': PositionSet(t_pos),
+                                                          '-': PositionSet(gap_pos),
+                                                          # add reference ignore positions back in, copying the
+                                                          # reference set is cheaper than inserting them one by one
+                                                          'N': ref_ign_pos[con_id] | PositionSet(n_pos)}
+        var_cur.close()
 
     except psycopg2.Error as e:
          logging.error("Database reported error: %s" % (str(e)))
@@ -136,12 +237,82 @@ def get_data_from_db(db, samples_in, refname):
     finally:
         # close all dbs
         cur.close()
-        conn.close()
+        if var_cur != None and not var_cur.closed:
+            var_cur.close()
+        _put_connection(db, conn)
 
     return all_contig_data
 
 # --------------------------------------------------------------------------------------------------
 
+def read_bed_intervals(bedfile):
+    """
+    Read a bed file into sorted, merged intervals per contig.
+
+    Parameters:
+    -----------
+    bedfile: str
+        bed file, tab separated contig, start, end
+
+    Returns:
+    --------
+    intervals: dict
+        {contig: ([start, start, ...], [end, end, ...]), ...}
+        sorted by start, overlapping and adjacent intervals merged, ends inclusive
+    """
+
+    raw = {}
+    with open(bedfile, 'r') as fp:
+        for line in fp:
+            # only the first three columns are needed, int() copes with the surrounding whitespace
+            data = line.split("\t", 3)
+            raw.setdefault(data[0].strip(), []).append((int(data[1]), int(data[2])))
+
+    intervals = {}
+    for contig, ranges in raw.items():
+        starts = []
+        ends = []
+        for (start, end) in sorted(ranges):
+            if len(ends) > 0 and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        intervals[contig] = (starts, ends)
+
+    return intervals
+
+# --------------------------------------------------------------------------------------------------
+
+def get_positions_in_intervals(positions, starts, ends):
+    """
+    Get the positions that fall into any of the intervals. Each position is
+    looked up with a binary search, so the intervals are never expanded.
+
+    Parameters:
+    -----------
+    positions: iterable
+        positions to check
+    starts: list
+        sorted interval starts as returned by read_bed_intervals
+    ends: list
+        matching inclusive interval ends
+
+    Returns:
+    --------
+    inside: PositionSet
+        the positions in any of the intervals
+    """
+
+    inside = PositionSet()
+    for pos in positions:
+        i = bisect_right(starts, pos) - 1
+        if i >= 0 and pos <= ends[i]:
+            inside.add(pos)
+    return inside
+
+# --------------------------------------------------------------------------------------------------
+
 def process_bed_file(args, all_contig_data):
     """
     Process a bed file with position intervals to include or exclude.
@@ -158,103 +329,208 @@ def process_bed_file(args, all_contig_data):
     0, but all_contig_data is updated
     """
 
-    all_samples = set()
-    for contig in all_contig_data.keys():
-        all_samples.update(all_contig_data[contig].keys())
-
     incl = True if args['include'] else False
     bedfile = args["exclude"] if args["exclude"] else args["include"]
 
-    with open(bedfile, 'r') as fp:
-        if args['whole_genome']:
-            # we've got the reference, so we're going to get a whole genome alignment
+    # read the whole file once, the positions are checked against the intervals
+    # rather than against every position in them
+    intervals = read_bed_intervals(bedfile)
+    for contig in list(intervals.keys()):
+        if contig not in all_contig_data:
+            logging.error("Wrong contig in bed file: %s. Ignoring.", contig)
+            del intervals[contig]
 
-            try: # the ref sequence itself will not be touched
-                all_samples.remove("reference")
-            except ValueError:
-                logging.error("reference not found in data structure.")
-                return -1
+    if args['whole_genome']:
+        # we've got the reference, so we're going to get a whole genome alignment
+
+        # the ref sequence itself will not be touched
+        if not any('reference' in data for data in all_contig_data.values()):
+            logging.error("reference not found in data structure.")
+            return -1
+
+        for contig, (starts, ends) in intervals.items():
+            bedpos = PositionSet()
+            for (start, end) in zip(starts, ends):
+                bedpos.update(range(start, end + 1))
 
             if incl == False:
-                # but we're excluding stuff from it
-                for line in fp:
-                    data = [x.strip() for x in line.split("\t")]
-                    bedrange = set(range(int(data[1]),int(data[2]) + 1))
-                    try:
-                        for sam in all_samples:
-                            # so we're removing the bed file positions from A, C, G, T, etc.
-                            for nuc in all_contig_data[data[0]][sam].keys():
-                                if nuc != 'N':
-                                    all_contig_data[data[0]][sam][nuc].difference_update(bedrange)
-                            # and we're adding them to N
-                            if all_contig_data[data[0]][sam].has_key('N'):
-                                all_contig_data[data[0]][sam]['N'].update(bedrange)
-                            else:
-                                all_contig_data[data[0]][sam]['N'] = bedrange
-                    except KeyError:
-                        logging.error("Wrong contig in bed file: %s. Ignoring.", data[0])
+                # but we're excluding stuff from it, these positions become N
+                new_ns = bedpos
             else:
-                # but we're including only certain regions
-                # 1st get one set of included positions per contig
-                inc_ranges = {}
-                for line in fp:
-                    data = [x.strip() for x in line.split("\t")]
-                    bedrange = set(range(int(data[1]),int(data[2]) + 1))
-                    try:
-                        inc_ranges[data[0]].update(bedrange)
-                    except KeyError:
-                        inc_ranges[data[0]] = bedrange
-
-                # now for each sample/contig
-                for sam in all_samples:
-                    for contig, include_range in inc_ranges.items():
-
-                        # get a set of positions that cover the whole contig but
-                        # leave out the positions we want to include
-                        conlen = len(args['reference'][contig])
-                        conrange = set(range(1, conlen+1))
-                        whole_contig_other_than_include_range = conrange.difference(include_range)
-
-                        try:
-                            # from all nucleotides that aren't N, remove all positions are aren't in the include range
-                            for nuc in all_contig_data[contig][sam].keys():
-                                if nuc != 'N':
-                                    all_contig_data[contig][sam][nuc].intersection_update(include_range)
-
-                            # add whole_contig_other_than_include_range positions to the N positions
-                            # for this sample/contig
-                            if all_contig_data[contig][sam].has_key('N'):
-                                all_contig_data[contig][sam]['N'].update(whole_contig_other_than_include_range)
-                            else:
-                                all_contig_data[contig][sam]['N'] = whole_contig_other_than_include_range
-                        except KeyError:
-                            logging.error("Wrong contig in bed file: %s. Ignoring.", contig)
-
-        else:
-            # if we haven't got a reference we'll get a variant-only alignment
-            for line in fp:
-                data = line.strip().split("\t")
-                try:
-                    for sam in all_samples:
-                        for nuc in all_contig_data[data[0]][sam].keys():
-                            if incl == True:
-                                # so for include we just remove all positions that ARE NOT in the bed file
-                                # effectively making them entirely invariant columns
-                                all_contig_data[data[0]][sam][nuc].intersection_update(range(int(data[1]),
-                                                                                             int(data[2]) + 1))
-                            else:
-                                # so for exclude we just remove all positions that ARE in the bed file
-                                # effectively making them entirely invariant columns
-                                all_contig_data[data[0]][sam][nuc].difference_update(range(int(data[1]),
-                                                                                           int(data[2]) + 1))
-                except KeyError:
-                    logging.error("Wrong contig in bed file: %s. Ignoring.", data[0])
+                # but we're including only certain regions, everything else becomes N
+                conlen = len(args['reference'][contig])
+                new_ns = PositionSet(range(1, conlen+1)).difference(bedpos)
+
+            # the samples on this contig, no need to collect them over all contigs first
+            for (sam, sam_data) in all_contig_data[contig].items():
+                if sam == 'reference':
+                    continue
+                for (nuc, positions) in sam_data.items():
+                    if nuc != 'N':
+                        inside = get_positions_in_intervals(positions, starts, ends)
+                        if incl == True:
+                            positions.intersection_update(inside)
+                        else:
+                            positions.difference_update(inside)
+                # every sample needs its own set, they are changed independently later
+                if 'N' in sam_data:
+                    sam_data['N'].update(new_ns)
+                else:
+                    sam_data['N'] = PositionSet(new_ns)
+
+    else:
+        # if we haven't got a reference we'll get a variant-only alignment
+        for contig, (starts, ends) in intervals.items():
+            for sam_data in all_contig_data[contig].values():
+                for positions in sam_data.values():
+                    inside = get_positions_in_intervals(positions, starts, ends)
+                    if incl == True:
+                        # so for include we just remove all positions that ARE NOT in the bed file
+                        # effectively making them entirely invariant columns
+                        positions.intersection_update(inside)
+                    else:
+                        # so for exclude we just remove all positions that ARE in the bed file
+                        # effectively making them entirely invariant columns
+                        positions.difference_update(inside)
 
     return 0
 
 # --------------------------------------------------------------------------------------------------
 
-def remove_columns(t, character, all_contig_data):
+def _get_fork_pool(processes):
+    """
+    **PRIVATE**
+
+    Get a pool of forked worker processes, so that the workers see the module globals
+    of the parent without them being pickled.
+
+    Parameters:
+    -----------
+    processes: int
+        number of processes
+
+    Returns:
+    --------
+    pool: obj
+        multiprocessing pool or None if processes can't be forked here
+    """
+
+    if os.name != 'posix':
+        return None
+    try:
+        ctx = multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2 always forks on posix
+        ctx = multiprocessing
+    except ValueError:
+        return None
+    return ctx.Pool(processes)
+
+# --------------------------------------------------------------------------------------------------
+
+# all_contig_data of the current map_over_contigs() call, inherited by the forked workers,
+# so the position sets are never pickled to them
+_FORK_DATA = None
+
+def _call_on_contig(job):
+    """
+    **PRIVATE**
+
+    Call func(data of the contig, *args) on the data in _FORK_DATA.
+    """
+
+    (func, contig, args) = job
+    return func(_FORK_DATA[contig], *args)
+
+# --------------------------------------------------------------------------------------------------
+
+def map_over_contigs(func, args, all_contig_data, processes=1):
+    """
+    Call func(all_contig_data[contig], *args) for every contig. With processes > 1 and
+    more than one contig the contigs are spread over forked worker processes. The workers
+    inherit all_contig_data when they are forked, only the contig names go to them and only
+    the results of func come back, so func should return little and change nothing.
+
+    Parameters:
+    -----------
+    func: function
+        module level function taking the data of one contig and args
+    args: tuple
+        further arguments for func, the same for all contigs
+    all_contig_data: dict
+        all data as described abobe in main
+    processes: int
+        number of processes
+
+    Returns:
+    --------
+    results: dict
+        {contig: return value of func, ...}
+    """
+
+    global _FORK_DATA
+
+    contigs = list(all_contig_data.keys())
+    pool = None
+    if processes > 1 and len(contigs) > 1:
+        # the data has to be in place before the workers are forked
+        _FORK_DATA = all_contig_data
+        pool = _get_fork_pool(min(processes, len(contigs)))
+        if pool == None:
+            logging.warning("Can't fork worker processes here, filtering in one process.")
+
+    if pool == None:
+        _FORK_DATA = None
+        return {contig: func(all_contig_data[contig], *args) for contig in contigs}
+
+    try:
+        results = pool.map(_call_on_contig, [(func, contig, args) for contig in contigs])
+    finally:
+        pool.close()
+        pool.join()
+        _FORK_DATA = None
+
+    return dict(zip(contigs, results))
+
+# --------------------------------------------------------------------------------------------------
+
+def get_columns_to_remove(data, t, character):
+    """
+    Get the columns on one contig where the fraction of samples with the
+    character [N, gap] is above t.
+
+    Parameters:
+    -----------
+    data: dict
+        the data of one contig {sample name: {nuc: positions}}, incl. the reference
+    t: float
+        threshold between 0.0 and 1.0
+    character: str
+        'N' or '-'
+
+    Returns:
+    --------
+    to_remove: PositionSet
+        columns to remove
+    """
+
+    all_pos = PositionSet()
+    for nuc in data['reference']:
+        all_pos.update(data['reference'][nuc])
+    # number of samples not considering the reference
+    nof_samples = len(data.keys()) - 1
+    # count in one pass over the positions each sample has rather than
+    # looking up every position in every sample
+    counts = Counter()
+    for (sam, sam_data) in data.items():
+        if sam != 'reference':
+            # sam_data has no key when sam doesn't have any Ns
+            counts.update(sam_data.get(character, ()))
+    return PositionSet([pos for (pos, ns) in counts.items() if float(ns) / nof_samples > t and pos in all_pos])
+
+# --------------------------------------------------------------------------------------------------
+
+def remove_columns(t, character, all_contig_data, processes=1):
     """
     Remove columns form the alignment if the character [N, gap] is above
     the fraction t in a column.
@@ -267,43 +543,75 @@ def remove_columns(t, character, all_contig_data):
         'N' or '-'
     all_contig_data: dict
         all data as described abobe in main
+    processes: int
+        number of processes to count the contigs in, only helps with several contigs
 
     Returns:
     --------
     0, but all_contig_data is updated
     """
 
-    for (contig, data) in all_contig_data.iteritems():
-        all_pos = set()
-        for nuc in data['reference']:
-            all_pos.update(data['reference'][nuc])
-        # number of samples not considering the reference
-        nof_samples = len(data.keys()) - 1
-        to_remove = set()
-        for pos in all_pos:
-            ns = 0
-            for sam in data.keys():
-                if sam != 'reference':
-                    try:
-                        if pos in data[sam][character]:
-                            ns += 1
-                    except KeyError:
-                        # happens when sam doesn't have any Ns
-                        pass
-            if float(ns) / nof_samples > t:
-                to_remove.add(pos)
+    removals = map_over_contigs(get_columns_to_remove, (t, character), all_contig_data, processes)
 
+    for (contig, to_remove) in removals.items():
         # remove postions
         if len(to_remove) > 0:
-            for sam in data.keys():
-                for nuc in data[sam].keys():
-                    data[sam][nuc].difference_update(to_remove)
+            for sam_data in all_contig_data[contig].values():
+                for positions in sam_data.values():
+                    # the intersection walks the smaller of the two, difference_update
+                    # on its own goes through all of to_remove for every set on 2.7
+                    positions.difference_update(positions & to_remove)
 
     return 0
 
 # --------------------------------------------------------------------------------------------------
 
-def remove_samples(args, option, character, all_contig_data):
+def get_only_reference_positions(data, dropped):
+    """
+    Get the positions on one contig that only the dropped samples have, i.e. the
+    positions that would be left in the reference alone once they are removed.
+
+    Parameters:
+    -----------
+    data: dict
+        the data of one contig {sample name: {nuc: positions}}, incl. the reference
+    dropped: list
+        names of the samples that are going to be removed
+
+    Returns:
+    --------
+    only_ref_pos: PositionSet
+        positions to remove from the reference
+    """
+
+    dropped = set(dropped)
+
+    # only positions of the dropped samples can end up in the reference alone,
+    # and only the ones in the reference matter
+    only_ref_pos = PositionSet()
+    for sam in dropped:
+        for positions in data.get(sam, {}).values():
+            only_ref_pos.update(positions)
+    ref_pos = PositionSet()
+    for positions in data['reference'].values():
+        ref_pos.update(positions)
+    only_ref_pos.intersection_update(ref_pos)
+
+    # a candidate stays when any remaining sample still has it,
+    # so only the candidates need checking against the rest and not the union of everything
+    for (sam, sam_data) in data.items():
+        if sam == 'reference' or sam in dropped:
+            continue
+        for positions in sam_data.values():
+            only_ref_pos.difference_update(only_ref_pos & positions)
+        if len(only_ref_pos) == 0:
+            break
+
+    return only_ref_pos
+
+# --------------------------------------------------------------------------------------------------
+
+def remove_samples(args, option, character, all_contig_data, processes=1):
     """
     Remove samples form the alignment if the character [N, gap] is above
     a given fraction in in samples (relative to the size of the genome.)
@@ -318,6 +626,8 @@ def remove_samples(args, option, character, all_contig_data):
         'N' or '-'
     all_contig_data: dict
         all data as described abobe in main
+    processes: int
+        number of processes to check the contigs in, only helps with several contigs
 
     Returns:
     --------
@@ -328,16 +638,12 @@ def remove_samples(args, option, character, all_contig_data):
     align_len = args["reflength"]
 
     # sum up the number of Ns or gaps for each sample
+    # this has to be counted here, the bed file and invariant N filters change the sets after loading
     ns_per_sample = {}
-    for (contig, data) in all_contig_data.iteritems():
-        for sam in data.keys():
-            if ns_per_sample.has_key(sam) == False:
-                ns_per_sample[sam] = 0
-            try:
-                ns_per_sample[sam] += len(data[sam][character])
-            except KeyError:
-                # this happens when sam has no Ns
-                pass
+    for (contig, data) in all_contig_data.items():
+        for (sam, sam_data) in data.items():
+            # sam_data has no key when sam has no Ns
+            ns_per_sample[sam] = ns_per_sample.get(sam, 0) + len(sam_data.get(character, ()))
 
     # calculate proportion of Ns or gaps
     for sam in ns_per_sample.keys():
@@ -346,42 +652,32 @@ def remove_samples(args, option, character, all_contig_data):
     # if this is set to auto calculate the threshold from the mean + 2 times the stddev
     t  = 0.0
     if args[option] == 'auto':
-        m = sum(ns_per_sample.values()) / len(ns_per_sample)
-        ssd = sum((x-m)**2 for x in ns_per_sample.values())
-        variance = ssd / len(ns_per_sample)
+        # fsum keeps the sums exact, which matters with many samples of similar fractions
+        fractions = list(ns_per_sample.values())
+        m = fsum(fractions) / len(fractions)
+        ssd = fsum([(x-m)**2 for x in fractions])
+        variance = ssd / len(fractions)
         sd = sqrt(variance)
         t = m + (args['sample_Ns_gaps_auto_factor']*sd)
     else:
         t = args[option]
 
     # remove all samples thath are bigger than the thresdold
-    removals = False
-    for sam in ns_per_sample.keys():
-        if ns_per_sample[sam] > t:
-            for (contig, data) in all_contig_data.iteritems():
-                logging.info("Removing sample %s, because it has %.3f %ss", sam, ns_per_sample[sam], character)
-                del data[sam]
-                removals = True
-
-    # tidy up
-    if removals == True:
-        for (contig, data) in all_contig_data.iteritems():
-            # get all positions in the reference and all positions in all other samples
-            ref_pos = set()
-            var_pos = set()
-            for sam in data.keys():
-                if sam == 'reference':
-                    for nuc in data[sam].keys():
-                        ref_pos.update(data[sam][nuc])
-                else:
-                    for nuc in data[sam].keys():
-                        var_pos.update(data[sam][nuc])
-            # get all positions that are only in the reference
-            only_ref_pos = ref_pos.difference(var_pos)
-            # remove the positions only in the reference from the reference
-            # because we probably removed the sample with a variant at those positions
+    # decide first, then take them out of every contig in one go and log each sample once
+    to_drop = [sam for sam in ns_per_sample.keys() if ns_per_sample[sam] > t]
+    for sam in to_drop:
+        logging.info("Removing sample %s, because it has %.3f %ss", sam, ns_per_sample[sam], character)
+
+    if len(to_drop) > 0:
+        # find what is left in the reference alone before the samples are gone
+        only_ref = map_over_contigs(get_only_reference_positions, (to_drop, ), all_contig_data, processes)
+        for (contig, data) in all_contig_data.items():
+            for sam in to_drop:
+                data.pop(sam, None)
+            # tidy up: remove the positions only in the reference from the reference
+            # because we removed the sample with a variant at those positions
             for nuc in data['reference'].keys():
-                data['reference'][nuc].difference_update(only_ref_pos)
+                data['reference'][nuc].difference_update(only_ref[contig])
 
     return 0
 
@@ -401,38 +697,28 @@ def output_per_sample_stats(all_contig_data):
     0
     """
 
-    all_contigs = all_contig_data.keys()
-    all_samples = set()
-    for contig in all_contigs:
-        all_samples.update(all_contig_data[contig].keys())
-    for sam in all_samples:
-        tot = 0
-        ns = 0
-        gaps = 0
-        mut = 0
-        mix = 0
-        for contig in all_contigs:
-            for k in all_contig_data[contig][sam].keys():
-                tot += len(all_contig_data[contig][sam][k])
-            try:
-                ns += len(all_contig_data[contig][sam]['N'])
-            except KeyError:
-                pass
+    # one walk over the data, summing up the set sizes per sample and character
+    lengths = {}
+    for data in all_contig_data.values():
+        for (sam, sam_data) in data.items():
             try:
-                gaps += len(all_contig_data[contig][sam]['-'])
+                sam_lengths = lengths[sam]
             except KeyError:
-                pass
-            for k in ['A', 'C', 'G', 'T']:
-                try:
-                    mut += len(all_contig_data[contig][sam][k])
-                except KeyError:
-                    pass
-            mixbases = set(all_contig_data[contig][sam].keys()).difference(['A', 'C', 'G', 'T', 'N', '-'])
-            for m in mixbases:
-                mix += len(all_contig_data[contig][sam][m])
+                sam_lengths = lengths[sam] = Counter()
+            sam_lengths.update(dict((k, len(v)) for (k, v) in sam_data.items()))
+
+    lines = []
+    for (sam, sam_lengths) in lengths.items():
+        tot = sum(sam_lengths.values())
+        ns = sam_lengths['N']
+        gaps = sam_lengths['-']
+        mut = sum([sam_lengths[k] for k in ['A', 'C', 'G', 'T']])
+        mix = tot - ns - gaps - mut
         if sam == 'reference':
             mut = 0
-        sys.stdout.write("%s\tN: %i, mut: %i, mix: %i, gap: %i, total: %i\n" %(sam, ns, mut, mix, gaps, tot))
+        lines.append("%s\tN: %i, mut: %i, mix: %i, gap: %i, total: %i\n" %(sam, ns, mut, mix, gaps, tot))
+    # one write for all samples
+    sys.stdout.write(''.join(lines))
 
     return 0
 
@@ -458,15 +744,13 @@ def get_snp_addresses(db, samples):
 
     try:
         # open db
-        conn = psycopg2.connect(db)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        conn = _get_connection(db)
+        cur = conn.cursor()
 
-        sql = "SELECT s.sample_name, c.t0, c.t5, c.t10, c.t25, c.t50, c.t100, c.t250 FROM samples s, sample_clusters c WHERE c.fk_sample_id=s.pk_id AND s.sample_name IN %s"
-        cur.execute(sql, (tuple(samples), ))
-        rows = cur.fetchall()
-        for r in rows:
-            snads[r['sample_name']] = "%i.%i.%i.%i.%i.%i.%i" \
-                          % (r['t250'], r['t100'], r['t50'], r['t25'], r['t10'], r['t5'], r['t0'])
+        sql = "SELECT s.sample_name, c.t250, c.t100, c.t50, c.t25, c.t10, c.t5, c.t0 FROM samples s, sample_clusters c WHERE c.fk_sample_id=s.pk_id AND s.sample_name = ANY(%s)"
+        cur.execute(sql, (list(samples), ))
+        for r in cur.fetchall():
+            snads[r[0]] = "%i.%i.%i.%i.%i.%i.%i" % tuple(r[1:])
 
     except psycopg2.Error as e:
          logging.error("Database reported error: %s" % (str(e)))
@@ -474,7 +758,7 @@ def get_snp_addresses(db, samples):
     finally:
         # close all dbs
         cur.close()
-        conn.close()
+        _put_connection(db, conn)
 
     return snads
 
@@ -501,12 +785,13 @@ def get_all_names(db, name_of_ref_in_db):
 
     try:
         # open db
-        conn = psycopg2.connect(db)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        conn = _get_connection(db)
+        # this is every sample in the database, so no DictRows
+        cur = conn.cursor()
 
         sql = "SELECT sample_name FROM samples WHERE sample_name!=%s"
         cur.execute(sql, (name_of_ref_in_db, ))
-        names = [r['sample_name'] for r in cur.fetchall()]
+        names = [r[0] for r in cur.fetchall()]
 
     except psycopg2.Error as e:
          logging.error("Database reported error: %s" % (str(e)))
@@ -514,7 +799,7 @@ def get_all_names(db, name_of_ref_in_db):
     finally:
         # close all dbs
         cur.close()
-        conn.close()
+        _put_connection(db, conn)
 
     return names
 
@@ -9,7 +9,7 @@ import logging
 from time import time
 import json
 import gzip
-from operator import itemgetter
+import sqlite3
 
 # --------------------------------------------------------------------------------------------------
 
@@ -32,36 +32,8 @@ def get_all_pw_dists(cur, samids):
     None if there is a problem
     """
 
-    # get list of contig ids from database
-    sql = "SELECT pk_id FROM contigs"
-    cur.execute(sql)
-    rows = cur.fetchall()
-    contig_ids = [r['pk_id'] for r in rows]
-
     samids = set(samids)
-    done = set()
-    dists = []
-
-    for s in samids:
-        # note the ones that are already done, so nothing is calculated twice.
-        done.add(s)
-        oths = samids.difference(done)
-
-        d = {}
-        for cid in contig_ids:
-
-            cur.callproc("get_sample_distances_by_id", [s, cid, list(oths)])
-            result = cur.fetchall()
-
-            for res in result:
-                if res[2] == None:
-                    res[2] = 0
-                try:
-                    d[res[0]] += res[2]
-                except KeyError:
-                    d[res[0]] = res[2]
-
-        dists += d.values()
+    dists = [d for (s1, s2, d) in get_pairwise_distances(cur, samids)]
 
     assert len(dists) == (len(samids) * (len(samids)-1))/2
 
@@ -69,7 +41,7 @@ def get_all_pw_dists(cur, samids):
 
 # --------------------------------------------------------------------------------------------------
 
-def get_relevant_distances(cur, sample_id):
+def get_relevant_distances(cur, sample_id, with_names=False, limit_with_ties=None):
     """
     Get the distances to this sample from the database.
 
@@ -79,6 +51,10 @@ def get_relevant_distances(cur, sample_id):
         database cursor
     sample_id: int
         sample pk_id
+    with_names: boolean
+        return sample names instead of sample ids, see get_distances()
+    limit_with_ties: int
+        only return the closest samples, see get_distances()
 
     Returns
     -------
@@ -88,13 +64,8 @@ def get_relevant_distances(cur, sample_id):
         None if fail
     """
 
-    # get the relevant samples from the database, these are the ones that have been clustered and are not ignored
-    sql = "SELECT c.fk_sample_id FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.ignore_sample IS FALSE"
-    cur.execute(sql)
-    rows = cur.fetchall()
-    relv_samples = [r['fk_sample_id'] for r in rows]
-
-    d = get_distances(cur, sample_id, relv_samples)
+    # the relevant samples are selected in the database, they never need to come here and go back
+    d = get_distances(cur, sample_id, None, with_names=with_names, limit_with_ties=limit_with_ties)
 
     return d
 
@@ -124,8 +95,7 @@ def get_missing_distances(cur, sample_id, haves):
     # get the relevant samples from the database, these are the ones that have been clustered and are not ignored
     sql = "SELECT c.fk_sample_id FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.ignore_sample IS FALSE"
     cur.execute(sql)
-    rows = cur.fetchall()
-    all_samples = set([r['fk_sample_id'] for r in rows])
+    all_samples = set([r[0] for r in cur.fetchall()])
 
     relv_samples = list(all_samples.difference(haves))
 
@@ -136,7 +106,7 @@ def get_missing_distances(cur, sample_id, haves):
 
 # --------------------------------------------------------------------------------------------------
 
-def get_distances(cur, samid, others):
+def get_distances(cur, samid, others, with_names=False, max_dist=None, limit_with_ties=None):
     """
     Get the distances of this sample to the other samples from the database.
 
@@ -147,45 +117,95 @@ def get_distances(cur, samid, others):
     sample_id: int
         sample pk_id
     others: list of int
-        other samples to calculate the distance to
+        other samples to calculate the distance to, None for all samples that have been
+        clustered and are not ignored
+    with_names: boolean
+        if True the sample names are joined onto the distances in the database
+        and returned instead of the sample ids [Default: False]
+    max_dist: int
+        if given only distances <= max_dist are returned [Default: None]
+    limit_with_ties: int
+        if given only the closest limit_with_ties samples are returned, plus all samples
+        that are as far away as the last one of them [Default: None]
 
     Returns
     -------
     d: list of tuples
         sorted list of tuples with (sample_id, distance) with closes sample first
         e.g. [(298, 0), (37, 3), (55, 4)]
+        or [(sample_name, distance), ...] if with_names is True
         None if fail
     """
 
-    # get list of contig ids from database
-    sql = "SELECT pk_id FROM contigs"
-    cur.execute(sql)
-    rows = cur.fetchall()
-    contig_ids = [r['pk_id'] for r in rows]
-
-    d = {}
-    for cid in contig_ids:
-        t0 = time()
-        cur.callproc("get_sample_distances_by_id", [samid, cid, others])
-        result = cur.fetchall()
-        t1 = time()
-        logging.info("Calculated %i distances on contig %i with 'get_sample_distances_by_id' in %.3f seconds", len(result), cid, t1 - t0)
-
-        # sum up if there are more than one contigs
-        for res in result:
-            if res[2] == None:
-                res[2] = 0
-            try:
-                d[res[0]] += res[2]
-            except KeyError:
-                d[res[0]] = res[2]
-
-    d = sorted(d.items(), key=itemgetter(1), reverse=False)
+    # run the distance function for all contigs in one statement rather than getting the contigs
+    # first and then waiting for one round trip per contig, and sum up over the contigs in there
+    # so that samples further away than max_dist never leave the database
+    if others == None:
+        # the relevant samples, these are the ones that have been clustered and are not ignored
+        others_sql = "ARRAY(SELECT c.fk_sample_id FROM sample_clusters c, samples s WHERE s.pk_id=c.fk_sample_id AND s.ignore_sample IS FALSE)"
+        args = [samid]
+    else:
+        others_sql = "%s"
+        args = [samid, others]
+    sql = "SELECT d.sid, sum(COALESCE(d.dist, 0))::integer AS dist FROM contigs c, LATERAL get_sample_distances_by_id(%s, c.pk_id, " + others_sql + ") AS d(sid, cid, dist) GROUP BY d.sid"
+    if max_dist != None:
+        sql += " HAVING sum(COALESCE(d.dist, 0)) <= %s"
+        args.append(max_dist)
+    if with_names == True:
+        sql = "SELECT s.sample_name, x.dist FROM (" + sql + ") x, samples s WHERE s.pk_id=x.sid"
+    if limit_with_ties != None:
+        # all ties get the same rank, the rank of the first of them
+        sql = "SELECT * FROM (SELECT x.*, rank() OVER (ORDER BY x.dist) AS rnk FROM (" + sql + ") x) y WHERE y.rnk <= %s"
+        args.append(limit_with_ties)
+    sql += " ORDER BY dist"
+
+    t0 = time()
+    cur.execute(sql, args)
+    d = [(r[0], r[1]) for r in cur.fetchall()]
+    t1 = time()
+    logging.info("Calculated %i distances on all contigs with 'get_sample_distances_by_id' in %.3f seconds", len(d), t1 - t0)
 
     return d
 
 # --------------------------------------------------------------------------------------------------
 
+def get_pairwise_distances(cur, samids):
+    """
+    Get the distances between all pairs of the given samples in one statement. The database
+    pairs every sample with all samples with a higher id and sums up over all contigs, so
+    there is no round trip per sample or per contig and no pair is calculated twice.
+
+    Parameters
+    ----------
+    cur: obj
+        database cursor
+    samids: list of int
+        sample ids
+
+    Returns
+    -------
+    dists: list of tuples
+        [(s1, s2, d), ...] with s1 < s2
+    """
+
+    samids = sorted(set(samids))
+    sql = "SELECT a.sid, d.sid, sum(COALESCE(d.dist, 0))::integer \
+           FROM (SELECT x AS sid, ARRAY(SELECT y FROM unnest(%s::integer[]) y WHERE y > x) AS oths FROM unnest(%s::integer[]) x) a, \
+                contigs c, \
+                LATERAL get_sample_distances_by_id(a.sid, c.pk_id, a.oths) AS d(sid, cid, dist) \
+           WHERE cardinality(a.oths) > 0 \
+           GROUP BY a.sid, d.sid"
+
+    t0 = time()
+    cur.execute(sql, (samids, samids, ))
+    dists = [(r[0], r[1], r[2]) for r in cur.fetchall()]
+    t1 = time()
+    logging.info("Calculated %i pairwise distances on all contigs with 'get_sample_distances_by_id' in %.3f seconds", len(dists), t1 - t0)
+
+    return dists
+
+# --------------------------------------------------------------------------------------------------
+
 def get_distance_matrix(cur, samids):
     """
     Get a distance matrix for the given samples.
@@ -205,51 +225,163 @@ def get_distance_matrix(cur, samids):
         dist[s2][s1] = d
     """
 
-    # get list of contig ids from database
-    sql = "SELECT pk_id FROM contigs"
-    cur.execute(sql)
-    rows = cur.fetchall()
-    contig_ids = [r['pk_id'] for r in rows]
+    dists = {s: {s: 0} for s in set(samids)}
+    for (s1, s2, d) in get_pairwise_distances(cur, samids):
+        dists[s1][s2] = d
+        dists[s2][s1] = d
 
-    samids = set(samids)
-    done = set()
-    dists = {}
+    return dists
+
+# --------------------------------------------------------------------------------------------------
+
+def complete_distance_matrix(cur, samids, dists):
+    """
+    Fill in the pairs that are missing from a partial distance matrix. Only the missing
+    pairs are calculated, one query per sample against all samples it still lacks.
 
+    Parameters
+    ----------
+    cur: obj
+        database cursor
+    samids: int
+        list of sample pk_ids
+    dists: dict
+        partial matrix, dist[s1][s2] = d, updated in place
+
+    Returns
+    -------
+    new: list of tuples
+        [(s1, s2, d), ...] for all pairs that were calculated, s1 < s2
+    """
+
+    samids = sorted(set(samids))
     for s in samids:
+        dists.setdefault(s, {})[s] = 0
+
+    new = []
+    for i, s in enumerate(samids):
+        oths = [o for o in samids[i+1:] if o not in dists[s]]
+        if len(oths) <= 0:
+            continue
+        for (o, d) in get_distances(cur, s, oths):
+            dists[s][o] = d
+            dists[o][s] = d
+            new.append((s, o, d))
+
+    return new
+
+# --------------------------------------------------------------------------------------------------
 
-        try:
-            dists[s][s] = 0
-        except KeyError:
-            dists[s] = {s: 0}
-
-        # note the ones that are already done, so nothing is calculated twice.
-        done.add(s)
-        oths = samids.difference(done)
-
-        d = {}
-        for cid in contig_ids:
-
-            cur.callproc("get_sample_distances_by_id", [s, cid, list(oths)])
-            result = cur.fetchall()
-
-            for res in result:
-                if res[2] == None:
-                    res[2] = 0
-                try:
-                    d[res[0]] += res[2]
-                except KeyError:
-                    d[res[0]] = res[2]
-        for osam, snpdi in d.items():
-            dists[s][osam] = snpdi
-            try:
-                dists[osam][s] = snpdi
-            except KeyError:
-                dists[osam] = {s: snpdi}
+def get_distance_matrix_cached(cur, samids, cachefile, known=None):
+    """
+    Get a distance matrix for the given samples like get_distance_matrix, but keep all
+    calculated distances in a local sqlite file, so later calls for overlapping sets of
+    samples only calculate the pairs that are not in there yet.
+
+    The distance between two samples never changes once they are in the database, so the
+    cache only needs to know which database it belongs to. A cache from another database
+    is emptied and then used for this one.
+
+    Parameters
+    ----------
+    cur: obj
+        database cursor
+    samids: int
+        list of sample pk_ids
+    cachefile: str
+        sqlite file, created if it does not exist
+    known: dict
+        distances the caller already has, same layout as the return value [optional]
+
+    Returns
+    -------
+    dist: dict
+        complete matrix
+        dist[s1][s2] = d
+        dist[s2][s1] = d
+    """
+
+    # the oid changes when the database is dropped and created again with the same name
+    cur.execute("SELECT oid, datname FROM pg_database WHERE datname=current_database()")
+    row = cur.fetchone()
+    db_key = "%s:%s" % (row[0], row[1])
+
+    cache = sqlite3.connect(cachefile)
+    try:
+        cache.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        cache.execute("CREATE TABLE IF NOT EXISTS dists (a INTEGER, b INTEGER, d INTEGER, PRIMARY KEY (a, b))")
+        res = cache.execute("SELECT value FROM meta WHERE key='database'").fetchone()
+        if res == None:
+            cache.execute("INSERT INTO meta VALUES ('database', ?)", (db_key, ))
+        elif res[0] != db_key:
+            # the distances in there can be for entirely different samples with the same ids
+            logging.warning("Distance cache %s belongs to a different database (%s). Discarding its %i distances.",
+                            cachefile, res[0], cache.execute("SELECT count(*) FROM dists").fetchone()[0])
+            cache.execute("DELETE FROM dists")
+            cache.execute("UPDATE meta SET value=? WHERE key='database'", (db_key, ))
+
+        samids = sorted(set(samids))
+        dists = {s: {s: 0} for s in samids}
+        if known != None:
+            for a, row in known.items():
+                for b, d in row.items():
+                    if a in dists and b in dists:
+                        dists[a][b] = d
+                        dists[b][a] = d
+
+        # get what we have, pairs are stored with the smaller id first
+        cache.execute("CREATE TEMP TABLE req (id INTEGER PRIMARY KEY)")
+        cache.executemany("INSERT INTO req VALUES (?)", [(s, ) for s in samids])
+        nof_cached = 0
+        for (a, b, d) in cache.execute("SELECT a, b, d FROM dists WHERE a IN (SELECT id FROM req) AND b IN (SELECT id FROM req)"):
+            dists[a][b] = d
+            dists[b][a] = d
+            nof_cached += 1
+
+        # calculate the rest
+        new = complete_distance_matrix(cur, samids, dists)
+
+        logging.info("Distance cache: %i pairs found, %i pairs calculated.", nof_cached, len(new))
+
+        cache.executemany("INSERT OR REPLACE INTO dists VALUES (?, ?, ?)", new)
+        cache.commit()
+    finally:
+        cache.close()
 
     return dists
 
 # --------------------------------------------------------------------------------------------------
 
+def get_mean_distances(cur, samids):
+    """
+    Get the mean distance of each of the given samples to all other given samples.
+
+    Parameters
+    ----------
+    cur: obj
+        database cursor
+    samids: list of int
+        list of sample pk_ids, at least two
+
+    Returns
+    -------
+    means: dict
+        means[s] = mean distance of s to all others
+    """
+
+    # every pair is only calculated once for the matrix
+    dist_mat = get_distance_matrix(cur, samids)
+
+    # the diagonal is 0, so the row sum is the sum of the distances to all others
+    means = {}
+    for (s, row) in dist_mat.items():
+        assert len(row) == len(dist_mat)
+        means[s] = sum(row.values()) / float(len(row) - 1)
+
+    return means
+
+# --------------------------------------------------------------------------------------------------
+
 def get_distances_precalc(cur, sam_id, sample_name, json_file_name):
     """
     Check the precalculated data against the database, get the missing distances,
@@ -42,8 +42,8 @@ def check_merging_needed(cur, distances, new_snad, levels=[0, 5, 10, 25, 50, 100
             # get all samples ids where the sample is <= threshold away
             samples = [s for (s, d) in distances if d <= lvl]
             # get the cluster names for all of these samples
-            sql = "SELECT t"+str(lvl)+" FROM sample_clusters WHERE fk_sample_id IN %s"
-            cur.execute(sql, (tuple(samples), ))
+            sql = "SELECT t"+str(lvl)+" FROM sample_clusters WHERE fk_sample_id = ANY(%s)"
+            cur.execute(sql, (list(samples), ))
             # use clustre name as the key in dict to test if they are all the same
             clusters = {r['t'+str(lvl)]: None for r in cur.fetchall()}
             # if there is only one, it means that all the samples <= t from the new samples are in
@@ -57,7 +57,7 @@ def check_merging_needed(cur, distances, new_snad, levels=[0, 5, 10, 25, 50, 100
                 sizes = {}
                 for row in rows:
                     sizes[row['cluster_name']] = row['nof_members']
-                oMer = ClusterMerge(level=lvl, clusters=clusters.keys(), sizes=sizes)
+                oMer = ClusterMerge(level=lvl, clusters=list(clusters.keys()), sizes=sizes)
                 merges[lvl] = oMer
 
     return merges
@@ -177,32 +177,3 @@ def do_the_merge(cur, oMerge):
     return None
 
 # --------------------------------------------------------------------------------------------------
-
-def get_mean_distance_for_merged_cluster(cur, samid, mems):
-    """
-    Get the mean distance of a sample (samid) to all samples in the mems list.
-
-    Parameters
-    ----------
-    cur: obj
-        database cursor
-    samid: int
-        sample_id
-    mems: list of int
-        all members if this cluster
-    Returns
-    -------
-    m: float
-        mean distance
-    """
-
-    m = None
-    assert samid in mems
-    others = [x for x in mems if x != samid]
-    dists = get_distances(cur, samid, others)
-    d = [d for (s, d) in dists]
-    assert len(d) == len(others)
-    m = sum(d) / float(len(d))
-    return m
-
-# --------------------------------------------------------------------------------------------------
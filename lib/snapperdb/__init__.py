@@ -9,8 +9,8 @@ import logging
 
 from lib.utils import get_closest_threshold
 from lib.ClusterStats import ClusterStats
-from lib.distances import get_distances
-from lib.merging import get_stats_for_merge, get_mean_distance_for_merged_cluster
+from lib.distances import get_distances, get_mean_distances
+from lib.merging import get_stats_for_merge
 
 # --------------------------------------------------------------------------------------------------
 
@@ -183,7 +183,7 @@ def check_zscores(cur, distances, new_snad, merges, levels=[0, 5, 10, 25, 50, 10
 
         oStats = None
         # if we need to merge
-        if merges.has_key(lvl):
+        if lvl in merges:
 
             # if there is a merge, we first need to calculate the stats for the newly created merged cluster
             logging.warning("Merge required at level %s between clusters %s. z-score will be checked for the new cluster resulting from this merge!", lvl, str(merges[lvl]))
@@ -230,14 +230,17 @@ def check_zscores(cur, distances, new_snad, merges, levels=[0, 5, 10, 25, 50, 10
         # do this for all members of the cluster
         nof_mems = len(current_mems)
         merge_per_sample_stats = {}
+        if lvl in merges:
+            # there was a merge, so we can't use what's in the db
+            # get the mean distances for all members from one distance matrix
+            merge_per_sample_stats = get_mean_distances(cur, current_mems)
+
         for c_mem in current_mems:
 
             # get the mean distance of this sample to all other samples in the cluster (w/o the one to be added)
             old_medis = None
-            if merges.has_key(lvl) == True:
-                # there was a merge, so we can't use what's in the db
-                old_medis = get_mean_distance_for_merged_cluster(cur, c_mem, current_mems)
-                merge_per_sample_stats[c_mem] = old_medis
+            if lvl in merges:
+                old_medis = merge_per_sample_stats[c_mem]
             else:
                 # if there was no merge, get the mean distance of this member to all other members
                 # (excluding the one to be added) from the database
@@ -266,7 +269,7 @@ def check_zscores(cur, distances, new_snad, merges, levels=[0, 5, 10, 25, 50, 10
                 info.append(mess)
 
         # if there was a merge we want to remember that we already calculated all this stuff
-        if merges.has_key(lvl) == True:
+        if lvl in merges:
             merges[lvl].member_stats = merge_per_sample_stats
 
     return fail, info
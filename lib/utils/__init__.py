@@ -28,7 +28,7 @@ def check_json_format(data):
     """
 
     op = False
-    if data.has_key('positions') == False:
+    if 'positions' not in data:
         return op
 
     contigs = data['positions'].keys()
@@ -96,7 +96,7 @@ def get_the_data_from_the_input(args):
         dRef = None
         dInp = None
         try:
-            with open_func(args['input']) as fasta:
+            with open_func(args['input'], 'rt') as fasta:
                 dInp = read_fasta(fasta)
         except IOError:
             logging.error("Could not open file %s", args['input'])
@@ -104,7 +104,7 @@ def get_the_data_from_the_input(args):
 
         try:
             open_func = gzip.open if args['reference'].endswith('.gz') == True else open
-            with open_func(args['reference']) as ref:
+            with open_func(args['reference'], 'rt') as ref:
                 dRef = read_fasta(ref)
         except IOError:
             logging.error("Could not open file %s", args['reference'])
@@ -264,7 +264,7 @@ def calculate_nless_n50(data, fasta):
         dInp = read_fasta(f)
 
     lens = []
-    for con, condata in data['positions'].iteritems():
+    for con, condata in data['positions'].items():
         n_list = list(condata['N'])
         n_list.sort()
 
@@ -9,4 +9,6 @@ echo "Creating tables in $DB"
 psql -U $USER -h $HOST $DB < setup_snapper3_db.sql
 echo "Creating functions in $DB"
 psql -U $USER -h $HOST $DB < add_psql_functions.sql
+echo "Creating indexes in $DB"
+psql -U $USER -h $HOST $DB < add_indexes.sql
 echo "Finished!"
@@ -158,7 +158,7 @@ def main(args):
 
         logging.info("Created new sampe with id %s. ", ref_pkid)
 
-        for con, condata in data['positions'].iteritems():
+        for con, condata in data['positions'].items():
             # get the pk of this contig
             try:
                 contig_pkid = contigs[con]
@@ -170,7 +170,7 @@ def main(args):
             # we treat these as Ns
             ref_ign_pos = set(condata['N']).union(set(condata['-']))
             # add additional global ignore positions as ref Ns to the database
-            if exclude_regions != None and exclude_regions.has_key(con):
+            if exclude_regions != None and con in exclude_regions:
                 ref_ign_pos.update(exclude_regions[con])
 
             # make one entry per contig in the variants table
@@ -144,7 +144,7 @@ def main(args):
     # if format is json, check if there are any annotations to check and check them
     if args['format'] == 'json':
         if args['mcov'] != None:
-            if data['annotations'].has_key('coverageMetaData') == False:
+            if 'coverageMetaData' not in data['annotations']:
                 logging.error("Was asked to check coverage but no coverage annotation found in json file.")
                 return 1
             cov_info = dict(item.split("=") for item in data['annotations']['coverageMetaData'].split(","))
@@ -153,7 +153,7 @@ def main(args):
                 logging.error("The mean coverage for this sample is below the user specified threshold.")
                 return 1
         if args['nless'] != None:
-            if data['annotations'].has_key('nlessnessMetaData') == False:
+            if 'nlessnessMetaData' not in data['annotations']:
                 logging.error("Was asked to check nlessness but no nlessness annotation found in json file.")
                 return 1
             nless_info = dict(item.split("=") for item in data['annotations']['nlessnessMetaData'].split(","))
@@ -205,7 +205,7 @@ def main(args):
 
         logging.info("Created new sampe with id %s. ", sample_pkid)
 
-        for con, condata in data['positions'].iteritems():
+        for con, condata in data['positions'].items():
             # get the pk of this contig
             try:
                 contig_pkid = contigs[con]
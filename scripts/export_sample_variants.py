@@ -118,7 +118,7 @@ def main(args):
         logging.info("Writing data to file: %s", filename)
         json_string = json.dumps(data)
         with gzip.open(filename, mode='wb') as gzip_obj:
-            gzip_obj.write(json_string)
+            gzip_obj.write(json_string.encode('utf-8'))
 
     except psycopg2.Error as e:
          logging.error("Database reported error: %s" % (str(e)))
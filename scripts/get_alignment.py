@@ -116,6 +116,10 @@ Fraction expressed as fraction of genome. Requires --reflength or --reference.""
                       type=float,
                       help="""When using 'auto' option for --sample-gaps or --sample-Ns, remove sample that have
 gaps or Ns this many times above the stddev of all samples. [Default: 2.0]""")
+    args.add_argument("--processes",
+                      type=int,
+                      default=1,
+                      help="Number of processes to filter samples and columns on several contigs with. [Default: 1]")
     args.add_argument("--snp-address",
                       action='store_true',
                       help="Annotate fasta sample header with SNP address where available. [Default: don't]")
@@ -212,8 +216,8 @@ def main(args):
 
     # check that there is no conflicting ref bases by verifying that the
     # intersection between two ref bases sets of positions is always empty
-    for (contig, data) in all_contig_data.iteritems():
-        ref_bases = data['reference'].keys()
+    for (contig, data) in all_contig_data.items():
+        ref_bases = list(data['reference'].keys())
         for i in range(0, len(ref_bases)):
             for j in range(0, len(ref_bases)):
                 if i < j:
@@ -269,35 +273,35 @@ def main(args):
 
     if args['remove_invariant_npos'] == True:
         logging.info("Removing invariant N positions.")
-        for (contig, data) in all_contig_data.iteritems():
+        for (contig, data) in all_contig_data.items():
             # get all positions that are N and all others in all samples except the reference
-            n_pos = set()
-            var_pos = set()
-            for sam in data.keys():
+            n_pos = align.PositionSet()
+            var_pos = align.PositionSet()
+            for (sam, sam_data) in data.items():
                 if sam != 'reference':
-                    for nuc in data[sam].keys():
+                    for (nuc, positions) in sam_data.items():
                         if nuc == 'N':
-                            n_pos.update(data[sam][nuc])
+                            n_pos.update(positions)
                         else:
-                            var_pos.update(data[sam][nuc])
+                            var_pos.update(positions)
             # get positions that are onlys in nothing else in any sample
             only_n_pos = n_pos.difference(var_pos)
             # remove those positions from all samples including the reference
-            for sam in data.keys():
-                for nuc in data[sam].keys():
-                    data[sam][nuc].difference_update(only_n_pos)
+            for sam_data in data.values():
+                for positions in sam_data.values():
+                    positions.difference_update(only_n_pos)
 
     if args['sample_Ns']:
-        align.remove_samples(args, 'sample_Ns', 'N', all_contig_data)
+        align.remove_samples(args, 'sample_Ns', 'N', all_contig_data, args['processes'])
 
     if args['sample_gaps']:
-        align.remove_samples(args, 'sample_gaps', '-', all_contig_data)
+        align.remove_samples(args, 'sample_gaps', '-', all_contig_data, args['processes'])
 
     if args['column_Ns']:
-        align.remove_columns(args['column_Ns'], 'N', all_contig_data)
+        align.remove_columns(args['column_Ns'], 'N', all_contig_data, args['processes'])
 
     if args['column_gaps']:
-        align.remove_columns(args['column_gaps'], '-', all_contig_data)
+        align.remove_columns(args['column_gaps'], '-', all_contig_data, args['processes'])
 
     # finished filtering
     logging.info("Filtering complete.")
@@ -308,7 +312,7 @@ def main(args):
 
     # output now
     dSeqs = {}
-    for (contig, data) in all_contig_data.iteritems():
+    for (contig, data) in all_contig_data.items():
         dAlign = {}
         # get all positions
         if args["whole_genome"]:
@@ -336,15 +340,15 @@ def main(args):
                 # initialies with 0's
                 dAlign[sample_name] = ['0'] * len(all_pos)
                 # set all bases to reference
-                for nuc in data['reference'].keys():
-                    for i in data['reference'][nuc]:
+                for (nuc, positions) in data['reference'].items():
+                    for i in positions:
                         seq_pos = all_pos[i]
                         # use AlignmentPosition to preserve information about the original genome position
                         dAlign[sample_name][seq_pos] = AlignmentPosition(nuc=nuc, contig=contig, pos=i)
 
             # overwrite reference positions where necessary
-            for nuc in data[sample_name].keys():
-                for i in data[sample_name][nuc]:
+            for (nuc, positions) in data[sample_name].items():
+                for i in positions:
                     seq_pos = all_pos[i]
                     # use AlignmentPosition to preserve information about the original genome position
                     dAlign[sample_name][seq_pos] = AlignmentPosition(nuc=nuc, contig=contig, pos=i)
@@ -358,21 +362,47 @@ def main(args):
     if args["remove_ref"] != 'keep':
         dSeqs = align.remove_reference(dSeqs, args["whole_genome"], args['remove_ref'])
 
-    # write to file
-    with open(args["out"], "w") as fp:
-        # write seqs to file
-        for name, seq in dSeqs.iteritems():
-            # seq is a list of AlignmentPosition objects
-            seq = ''.join([x.nuc for x in seq])
-            # now it's a string
-            if dSnads != None and dSnads.has_key(name):
-                fp.write(">%s %s\n%s\n" % (name, dSnads[name], seq))
-            else:
-                fp.write(">%s\n%s\n" % (name, seq))
+    # write to file, or to the file-like object we were given when called internally
+    if hasattr(args["out"], "write") == True:
+        write_alignment(args["out"], dSeqs, dSnads)
+    else:
+        with open(args["out"], "w") as fp:
+            write_alignment(fp, dSeqs, dSnads)
 
     return 0
 
 # --------------------------------------------------------------------------------------------------
 
+def write_alignment(fp, dSeqs, dSnads):
+    """
+    Write the alignment in fasta format.
+
+    Parameters
+    ----------
+    fp: obj
+        open file or anything else with a write method
+    dSeqs: dict
+        {sample name: list of AlignmentPosition objects}
+    dSnads: dict
+        {sample name: snp address} or None
+
+    Returns
+    -------
+    None
+    """
+
+    for name, seq in dSeqs.items():
+        # seq is a list of AlignmentPosition objects
+        seq = ''.join([x.nuc for x in seq])
+        # now it's a string
+        if dSnads != None and name in dSnads:
+            fp.write(">%s %s\n%s\n" % (name, dSnads[name], seq))
+        else:
+            fp.write(">%s\n%s\n" % (name, seq))
+
+    return None
+
+# --------------------------------------------------------------------------------------------------
+
 if __name__ == "__main__":
     exit(main(vars(get_args().parse_args())))
@@ -72,6 +72,14 @@ Choose from 'ML' or 'NJ'. REQUIRED.""")
                       dest="dm",
                       help="""Store distance matrix as csv in this file. Ignored for ML. [Default: Do not store]""")
 
+    args.add_argument("--distance-cache",
+                      type=str,
+                      metavar="FILENAME",
+                      default=None,
+                      dest="dist_cache",
+                      help="""Keep all calculated distances in this sqlite file and reuse them in later runs
+against the same database. Ignored for ML. [Default: Do not cache]""")
+
     args.add_argument("--samples",
                       "-s",
                       type=str,
@@ -173,6 +181,7 @@ def main(args):
                                    ref=args['ref'],
                                    refname=args['refname'],
                                    dm=args['dm'],
+                                   dist_cache=args['dist_cache'],
                                    rmref=args['remove_ref'])
             with open(args['output'], 'w') as f:
                 f.write(result)
@@ -226,7 +226,7 @@ def calculate_per_cluster_stats(target_cur, dm):
             clu = r[lvl]
             # number of members and number of pairwise dists
             nof_mems = r['nof_members']
-            nof_pw_dists = ((nof_mems**2) - nof_mems) / 2
+            nof_pw_dists = ((nof_mems**2) - nof_mems) // 2
 
             # if we have only one member we have no pw dists and we cannot compute mean and ssd
             if nof_pw_dists > 0:
@@ -454,7 +454,7 @@ def migrate_variants(ref, source_cur, target_cur, all_sample_names):
             sample_vars[conname]['-'] = set()
 
         data = []
-        for conname, contig_id in dContigs.iteritems():
+        for conname, contig_id in dContigs.items():
 
             # remove ignore positions for the reference from all position sets in this sample
             for x in ['A', 'C', 'G', 'T', 'N', '-']:
@@ -530,7 +530,7 @@ def add_ref_and_get_ign_pos(ref, source_cur, target_cur, dContigs, dIgn):
         sample_vars[conname] = set([dIgn[iid]['pos'] for iid in r['ignored_pos'] if dIgn[iid]['contig'] == conname])
 
     data = []
-    for conname, contig_id in dContigs.iteritems():
+    for conname, contig_id in dContigs.items():
         data.append((sample_id,
                      contig_id,
                      list(),
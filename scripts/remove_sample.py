@@ -433,7 +433,7 @@ def split_clusters(cur, sample_id, problems, lvl, distances):
             # get a set of all samples that are already in one of the groups
             _ = [visited.update(x) for x in groups.values()]
             # if we already expanded from that node or went past it in a previous group, don't go
-            if groups.has_key(node) or (node in visited):
+            if node in groups or (node in visited):
                 continue
             else:
                 groups[node] = expand_from_node(cur, node, c, lvl, distances, sample_id)
@@ -575,8 +575,8 @@ def update_cluster_stats_post_removal(cur, sid, clu, lvl, distances, split, zscr
             update_sample_history(cur, t_lvl, new_clu_name, grli)
 
             # put all members of this subcluster in the new cluster in the database
-            sql = "UPDATE sample_clusters SET "+t_lvl+"=%s WHERE fk_sample_id IN %s"
-            cur.execute(sql, (new_clu_name, tuple(grli), ))
+            sql = "UPDATE sample_clusters SET "+t_lvl+"=%s WHERE fk_sample_id = ANY(%s)"
+            cur.execute(sql, (new_clu_name, list(grli), ))
 
             # calculate the mean distance to all other members from scratch for all members of this newly
             # created subcluster and update in the database
@@ -773,7 +773,7 @@ def check_cluster_integrity(cur, sample_id, snad, distances, levels=[0, 5, 10, 2
                 # we want to know for updating later
 
         # we checked all pairs and always found b somehow, cluster is fine
-        if splits.has_key(lvl) == False:
+        if lvl not in splits:
             splits[lvl] = None
 
     return splits
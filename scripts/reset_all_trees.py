@@ -95,6 +95,9 @@ def main():
         # open db
         conn = psycopg2.connect(oArgs.db)
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        # a tree is made for every cluster, they all take the same connection from the pool
+        # rather than connecting to the database again each time
+        SnapperDBInterrogation.init_pool(1, 1, oArgs.db)
 
         empty_trees_table(cur)
 
@@ -112,8 +115,8 @@ def main():
 
             logging.info("The tree for t5 cluster %s will contain %i samples.", t5_name, len(tree_samples))
 
-            sql = "SELECT sample_name FROM samples WHERE pk_id IN %s"
-            cur.execute(sql, (tuple(tree_samples), ))
+            sql = "SELECT sample_name FROM samples WHERE pk_id = ANY(%s)"
+            cur.execute(sql, (list(tree_samples), ))
             rows = cur.fetchall()
             sample_names = set([r['sample_name'] for r in rows])
 
@@ -148,8 +151,11 @@ def main():
         logging.error("Could not complete tree creation because: %s" % (str(e)))
     except psycopg2.Error as e:
          logging.error("Database reported error: %s" % (str(e)))
+    except SnapperDBInterrogationError as e:
+         logging.error("Could not connect for making trees: %s" % (str(e)))
     finally:
         # close all dbs
+        SnapperDBInterrogation.close_pool()
         cur.close()
         conn.close()
 
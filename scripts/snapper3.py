@@ -43,7 +43,7 @@ def get_version():
     if os.path.exists(version_file):
         try:
             with open(version_file) as fp:
-                version = fp.next().strip()
+                version = next(fp).strip()
         except IOError:
             pass
     return version
@@ -86,6 +86,9 @@ def main(args):
         # open db
         conn = psycopg2.connect(args['db'])
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        # a tree is made for every cluster, they all take the same connection from the pool
+        # rather than connecting to the database again each time
+        SnapperDBInterrogation.init_pool(1, 1, args['db'])
 
         # get all t5 clusters that have 3 or more members
         t5_clusters = list()
@@ -136,8 +139,11 @@ def main(args):
 
     except psycopg2.Error as e:
          logging.error("Database reported error: %s" % (str(e)))
+    except SnapperDBInterrogationError as e:
+         logging.error("Could not connect for making trees: %s" % (str(e)))
     finally:
         # close all dbs
+        SnapperDBInterrogation.close_pool()
         cur.close()
         conn.close()
 
@@ -256,8 +262,8 @@ def update_an_existing_tree(cur, conn, tree_row_id, t5_name, t5_members, tree_sa
     needs_update = False
 
     # get the maximum t0 cluster number in the previous tree
-    sql = "SELECT max(t0) FROM sample_clusters WHERE fk_sample_id IN %s"
-    cur.execute(sql, (tuple(tree_sample_set), ), )
+    sql = "SELECT max(t0) FROM sample_clusters WHERE fk_sample_id = ANY(%s)"
+    cur.execute(sql, (list(tree_sample_set), ), )
     tree_t0_max = cur.fetchone()[0]
 
     logging.debug("Max t0 in this tree is: %i", tree_t0_max)
@@ -364,8 +370,8 @@ def get_sample_names(cur, tree_sample_set):
         names of these samples
     """
 
-    sql = "SELECT sample_name FROM samples WHERE pk_id IN %s"
-    cur.execute(sql, (tuple(tree_sample_set), ))
+    sql = "SELECT sample_name FROM samples WHERE pk_id = ANY(%s)"
+    cur.execute(sql, (list(tree_sample_set), ))
     rows = cur.fetchall()
     sample_names = set([r['sample_name'] for r in rows])
 
@@ -423,8 +429,8 @@ def get_t50_cluster(cur, t5_name, t5_members):
 
     t50_cluster = set()
 
-    sql = "SELECT c.t50 AS tfifty FROM sample_clusters c, samples s WHERE c.fk_sample_id IN %s AND c.fk_sample_id=s.pk_id AND s.ignore_zscore=FALSE"
-    cur.execute(sql, (tuple(t5_members), ))
+    sql = "SELECT c.t50 AS tfifty FROM sample_clusters c, samples s WHERE c.fk_sample_id = ANY(%s) AND c.fk_sample_id=s.pk_id AND s.ignore_zscore=FALSE"
+    cur.execute(sql, (list(t5_members), ))
     rows = cur.fetchall()
     t50_cluster.update([r['tfifty'] for r in rows])
 
@@ -459,8 +465,8 @@ def filter_samples_to_be_checked(cur, samples, tree_t0_max):
     t0len = {}
 
     # get the t0 for each member in the set of samples
-    sql = "SELECT fk_sample_id, t0 FROM sample_clusters WHERE fk_sample_id IN %s"
-    cur.execute(sql, (tuple(samples), ))
+    sql = "SELECT fk_sample_id, t0 FROM sample_clusters WHERE fk_sample_id = ANY(%s)"
+    cur.execute(sql, (list(samples), ))
     rows = cur.fetchall()
 
     for r in rows: